@@ -0,0 +1,77 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+# Named numpy arrays stored as a directory of .npy files plus a json header, so
+# they can be memory-mapped back (instead of unpickled) when loading.
+
+
+def save_arrays(dirname, meta, arrays):
+    """
+    save given dict of arrays (and json-serializable meta data) in a directory.
+    They are written to a temporary directory first, which then takes the place
+    of any existing one, so that is never left half-written (and arrays
+    memory-mapped from it can be saved)
+    """
+
+    tmpname = dirname + ".tmp"
+    if os.path.exists(tmpname):
+        shutil.rmtree(tmpname)
+    os.makedirs(tmpname)
+
+    for name, array in arrays.items():
+        with open(os.path.join(tmpname, name + ".npy"), "wb") as f:
+            np.save(f, array)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # meta data last: a directory with it has all its arrays
+    meta = dict(meta, arrays=sorted(arrays))
+    with open(os.path.join(tmpname, "meta.json"), "w") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    # directories cannot be replaced if not empty, move the old one aside first
+    oldname = dirname + ".old"
+    if os.path.exists(oldname):
+        shutil.rmtree(oldname)
+    if os.path.exists(dirname):
+        os.replace(dirname, oldname)
+    os.replace(tmpname, dirname)
+    if os.path.exists(oldname):
+        shutil.rmtree(oldname)
+
+
+def load_arrays(dirname, mmap=True):
+    "load arrays (memory-mapped, unless told otherwise) and meta data from a directory"
+
+    with open(os.path.join(dirname, "meta.json")) as f:
+        meta = json.load(f)
+
+    arrays = {
+        name: np.load(
+            os.path.join(dirname, name + ".npy"), mmap_mode="r" if mmap else None
+        )
+        for name in meta["arrays"]
+    }
+    return arrays, meta
+
+
+def pack_strings(strings):
+    "pack a list of strings into a utf8 byte array plus an array of offsets"
+
+    data = [s.encode("utf8") for s in strings]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(d) for d in data], out=offsets[1:])
+    return np.frombuffer(b"".join(data), dtype=np.uint8), offsets
+
+
+def unpack_strings(data, offsets):
+    "get back the list of strings packed by pack_strings"
+
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    return [data[a:b].decode("utf8") for a, b in zip(offsets, offsets[1:])]
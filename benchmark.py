@@ -0,0 +1,152 @@
+import os
+import csv
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# Measuring how fast and how well a trained model classifies a data set.
+
+
+def keras_predictor(model):
+    "get function predicting label probabilities for a batch with a Keras model"
+
+    # one graph for any batch shape, so varying lengths are not traced each time
+    signature = [[tf.TensorSpec(i.shape, tf.int32) for i in model.inputs]]
+    predict = tf.function(lambda X: model(X, training=False), input_signature=signature)
+    return lambda X: predict(X).numpy()
+
+
+def batches(codes, data, batch_size=32, trim=False):
+    """
+    encode data in batches of batch_size pairs (or sentences, for joint
+    models). Yields the pairs in each batch, the batch, and which of its
+    predictions are for those pairs (and not padding)
+    """
+
+    if codes.mode == "joint":
+        for P, X, _ in codes.encode_sentences(data, batch_size):
+            yield P[P >= 0], X, P >= 0
+        return
+
+    n = len(data.pair_types())
+    for start in range(0, n, batch_size):
+        pairs = np.arange(start, min(start + batch_size, n))
+        X, _ = codes.encode_batch(data, pairs, trim)
+        yield pairs, X, slice(None)
+
+
+def timed_predictions(predict, codes, data, batch_size=32, trim=False):
+    """
+    predict label codes for all pairs of data, one batch at a time, with given
+    function. Returns gold codes, predicted codes (null for pairs a joint model
+    cannot classify) and the seconds each batch took. The first batch is also
+    predicted once before timing, so building the graph is not counted
+    """
+
+    gold = codes.encode_labels(data)
+    pred = np.full(len(gold), codes.label_index.get("null", 0), dtype=gold.dtype)
+    times = []
+    for i, (pairs, X, valid) in enumerate(batches(codes, data, batch_size, trim)):
+        if i == 0:
+            predict(X)
+        t = time.perf_counter()
+        P = predict(X)
+        times.append(time.perf_counter() - t)
+        pred[pairs] = np.argmax(P, axis=-1)[valid]
+
+    return gold, pred, np.array(times)
+
+
+def macro_f1(gold, pred, n_labels, ignore=()):
+    "average F1 of given label codes, leaving out those in ignore"
+
+    scores = []
+    for c in range(n_labels):
+        if c in ignore:
+            continue
+        tp = np.sum((gold == c) & (pred == c))
+        fp = np.sum((gold != c) & (pred == c))
+        fn = np.sum((gold == c) & (pred != c))
+        scores.append(2 * tp / (2 * tp + fp + fn) if tp else 0.0)
+
+    return float(np.mean(scores)) if scores else 0.0
+
+
+def evaluate_predictor(predict, codes, data, batch_size=32, trim=False):
+    """
+    get median milliseconds per batch (after a warm-up call, so building the
+    graph does not count) and macro F1 (without null) of given predict function
+    on data
+    """
+
+    gold, pred, times = timed_predictions(predict, codes, data, batch_size, trim)
+    null = [codes.label2idx("null")] if "null" in codes.label_index else []
+    return {
+        "latency_ms": float(np.median(times)) * 1000,
+        "f1": macro_f1(gold, pred, codes.get_n_labels(), null),
+    }
+
+
+def evaluate(model, codes, data, batch_size=32, trim=False):
+    "get parameter count, median milliseconds per batch and F1 of model on data"
+
+    return {
+        "params": model.count_params(),
+        **evaluate_predictor(keras_predictor(model), codes, data, batch_size, trim),
+    }
+
+
+class Throughput(tf.keras.callbacks.Callback):
+    "measure training samples per second, leaving validation out"
+
+    def __init__(self, samples_per_epoch):
+        super().__init__()
+        self.samples_per_epoch = samples_per_epoch
+        self.times = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+        self.end = None
+
+    def on_test_begin(self, logs=None):
+        # validation runs at the end of each training epoch
+        if self.end is None:
+            self.end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.times.append((self.end or time.perf_counter()) - self.start)
+
+    def samples_per_second(self):
+        "get samples per second of the median epoch (not the first, slower one)"
+        return self.samples_per_epoch / float(np.median(self.times))
+
+
+def append_results(filename, row):
+    """
+    append row (a dict) to given CSV file, writing its header if new. Values
+    go under the columns of the existing header; if row has columns the file
+    lacks, the file is rewritten with them added at the end (empty for older
+    rows)
+    """
+
+    header = []
+    if os.path.exists(filename):
+        with open(filename, newline="") as f:
+            header = next(csv.reader(f), [])
+
+    if header and set(row) <= set(header):
+        with open(filename, "a", newline="") as f:
+            csv.DictWriter(f, fieldnames=header, restval="").writerow(row)
+        return
+
+    rows = []
+    if header:
+        with open(filename, newline="") as f:
+            rows = list(csv.DictReader(f))
+    fields = header + [k for k in row if k not in header]
+    with open(filename + ".tmp", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval="")
+        writer.writeheader()
+        writer.writerows(rows + [row])
+    os.replace(filename + ".tmp", filename)
@@ -1,22 +1,74 @@
+import os
+import sys
+import json
 import string
 import re
+import zlib
+import hashlib
+import threading
+import weakref
 
 import numpy as np
-from tensorflow.keras.preprocessing.sequence import pad_sequences
-from tensorflow.keras.utils import to_categorical
 
-from dataset import Dataset
+from arraystore import save_arrays, load_arrays, pack_strings, unpack_strings
+from dataset import Dataset, FIELDS, mask_keys
+
+# indexes kept in codemaps, mapping each key to a code
+INDEXES = [
+    "word_index",
+    "lc_word_index",
+    "lemma_index",
+    "pos_index",
+    "rel_index",
+    "label_index",
+]
+
+# sequence each pair is encoded as: its sentence, or its shortest dependency path.
+# Or, for joint models, each sentence encoded once for all pairs in it
+MODES = ["sentence", "sdp", "joint"]
+
+# version of the encoding, part of the key of cached encoded data sets so that
+# those encoded by older code are not reused
+ENCODING_VERSION = 2
+
+# token feature encoded for each network input, and the index used to encode it
+CHANNELS = [
+    ("form", "word_index"),
+    ("lc_form", "lc_word_index"),
+    ("rel", "rel_index"),
+    ("lemma", "lemma_index"),
+    ("pos", "pos_index"),
+]
 
 
 class Codemaps:
-    def __init__(self, data, maxlen=None):
+    def __init__(
+        self, data, maxlen=None, min_freq=1, hash_buckets=0, mode="sentence", window=0
+    ):
         """
         constructor, create mapper either from training data, or loading codemaps
-        from given file
+        from given file.
+
+        When created from training data, keys occurring less than min_freq times
+        (an int, or a dict by token feature) are left out of the indexes. They
+        are coded as UNK, like unseen keys, or as one of hash_buckets extra codes
+        per index if given. The mode (one of MODES) tells what sequence each
+        pair is encoded as: its whole sentence, or the dependency path between
+        its entities plus window tokens around it. Or, in joint mode, sentences
+        are encoded instead of pairs, with encode_sentences
         """
 
+        # key for each code of an index, built when first needed
+        self.__reverse = {}
+        # directory to keep encoded data sets in, if any
+        self.cachedir = None
+        # code tables for the strings of each data set encoded, filled under a
+        # lock since streaming pipelines encode from several threads
+        self.__tables = weakref.WeakKeyDictionary()
+        self.__lock = threading.Lock()
+
         if isinstance(data, Dataset) and maxlen is not None:
-            self.__create_indexs(data, maxlen)
+            self.__create_indexs(data, maxlen, min_freq, hash_buckets, mode, window)
 
         elif type(data) == str and maxlen is None:
             self.__load(data)
@@ -25,57 +77,68 @@ class Codemaps:
             print("codemaps: Invalid or missing parameters in constructor")
             exit()
 
-    def __create_indexs(self, data, maxlen):
+    def __create_indexs(self, data, maxlen, min_freq, hash_buckets, mode, window):
         """
         Create indexes from training data
 
-        Extract all words and labels in given sentences and
-        create indexes to encode them as numbers when needed
+        Count all words and labels in given sentences and
+        create indexes to encode the frequent enough ones as numbers when needed.
+        Tokens are counted once per sentence (not once per pair shown in it), and
+        entity masks are always kept
         """
 
         self.maxlen = maxlen
-        words = set([])
-        lc_words = set([])
-        lems = set([])
-        pos = set([])
-        labels = set([])
-        rel = set([])
-
-        for s in data.sentences():
-            for t in s["sent"]:
-                words.add(t["form"])
-                lc_words.add(t["lc_form"])
-                lems.add(t["lemma"])
-                pos.add(t["pos"])
-                rel.add(t["rel"])
-            labels.add(s["type"])
-
-        self.word_index = {w: i + 2 for i, w in enumerate(sorted(list(words)))}
-        self.word_index["PAD"] = 0  # Padding
-        self.word_index["UNK"] = 1  # Unknown words
-
-        self.lc_word_index = {w: i + 2 for i, w in enumerate(sorted(list(lc_words)))}
-        self.lc_word_index["PAD"] = 0  # Padding
-        self.lc_word_index["UNK"] = 1  # Unknown words
-
-        self.lemma_index = {s: i + 2 for i, s in enumerate(sorted(list(lems)))}
-        self.lemma_index["PAD"] = 0  # Padding
-        self.lemma_index["UNK"] = 1  # Unseen lemmas
-
-        self.pos_index = {s: i + 2 for i, s in enumerate(sorted(list(pos)))}
-        self.pos_index["PAD"] = 0  # Padding
-        self.pos_index["UNK"] = 1  # Unseen PoS tags
-
-        self.rel_index = {s: i + 2 for i, s in enumerate(sorted(list(rel)))}
-        self.rel_index["PAD"] = 0  # Padding
-        self.rel_index["UNK"] = 1  # Unseen PoS tags
-
+        self.hash_buckets = hash_buckets
+        self.mode = mode
+        self.window = window
+
+        _, ids = data.sentence_token_ids(np.unique(data.pair_sentences()))
+        strings = data.strings()
+
+        for field, index in CHANNELS:
+            cutoff = min_freq.get(field, 1) if isinstance(min_freq, dict) else min_freq
+            counts = np.bincount(ids[:, FIELDS.index(field)], minlength=len(strings))
+            masks = [strings.index(m) for m in mask_keys(field)]
+            seen = np.union1d(np.flatnonzero(counts), masks)
+            kept = np.union1d(seen[counts[seen] >= cutoff], masks)
+
+            keys = sorted(strings[i] for i in kept)
+            codes = {k: i + 2 for i, k in enumerate(keys)}
+            codes["PAD"] = 0  # Padding
+            codes["UNK"] = 1  # Unknown (or rare) keys
+            setattr(self, index, codes)
+
+            print(
+                f"codemaps: {field}: {len(seen)} keys, {len(kept)} kept "
+                f"(covering {counts[kept].sum() / max(len(ids), 1):.2%} of tokens)"
+                + (f", plus {hash_buckets} hash buckets" if hash_buckets else ""),
+                file=sys.stderr,
+            )
+
+        labels = set(strings[t] for t in np.unique(data.pair_types()))
         self.label_index = {t: i for i, t in enumerate(sorted(list(labels)))}
 
     def __load(self, name):
-        "load indexes"
+        "load indexes, from binary codemaps if there are, or old text ones"
+
+        if os.path.isdir(name + ".cmap"):
+            arrays, meta = load_arrays(name + ".cmap")
+            self.maxlen = meta["maxlen"]
+            self.hash_buckets = meta.get("hash_buckets", 0)
+            self.mode = meta.get("mode", "sentence")
+            self.window = meta.get("window", 0)
+            for index in INDEXES:
+                names = unpack_strings(
+                    arrays[index + "_strings"], arrays[index + "_offsets"]
+                )
+                setattr(self, index, {k: i for i, k in enumerate(names)})
+                self.__reverse[index] = names
+            return
 
         self.maxlen = 0
+        self.hash_buckets = 0
+        self.mode = "sentence"
+        self.window = 0
         self.word_index = {}
         self.lc_word_index = {}
         self.lemma_index = {}
@@ -102,72 +165,281 @@ class Codemaps:
                     self.rel_index[k] = int(i)
 
     def save(self, name):
-        "Save model and indexes"
-
-        # save indexes
-        with open(name + ".idx", "w") as f:
-            print("MAXLEN", self.maxlen, "-", file=f)
-            for key in self.label_index:
-                print("LABEL", key, self.label_index[key], file=f)
-            for key in self.word_index:
-                print("WORD", key, self.word_index[key], file=f)
-            for key in self.lc_word_index:
-                print("LCWORD", key, self.lc_word_index[key], file=f)
-            for key in self.lemma_index:
-                print("LEMMA", key, self.lemma_index[key], file=f)
-            for key in self.pos_index:
-                print("POS", key, self.pos_index[key], file=f)
-            for key in self.rel_index:
-                print("REL", key, self.rel_index[key], file=f)
+        "Save indexes, as the keys of each of them sorted by code"
+
+        arrays = {}
+        for index in INDEXES:
+            arrays[index + "_strings"], arrays[index + "_offsets"] = pack_strings(
+                self.__names(index)
+            )
+        meta = {
+            "maxlen": self.maxlen,
+            "hash_buckets": self.hash_buckets,
+            "mode": self.mode,
+            "window": self.window,
+        }
+        save_arrays(name + ".cmap", meta, arrays)
+
+    def fingerprint(self):
+        "get hash of everything that affects how data is encoded"
+
+        h = hashlib.sha256(
+            f"{self.maxlen} {self.hash_buckets} {self.mode} {self.window}".encode(
+                "utf8"
+            )
+        )
+        for index in INDEXES:
+            h.update(json.dumps([index, self.__names(index)]).encode("utf8"))
+        return h.hexdigest()
+
+    def set_cache(self, dirname):
+        """
+        keep data sets encoded with these codemaps in given directory, and load
+        them from there (memory-mapped) when encoding the same data again
+        """
+
+        os.makedirs(dirname, exist_ok=True)
+        self.cachedir = dirname
+
+    def __cached(self, data, names, encode):
+        """
+        get arrays with given names for data from the cache, or get them from
+        encode() and store them
+        """
+
+        if self.cachedir is None:
+            return encode()
+
+        key = hashlib.sha256(
+            f"{ENCODING_VERSION} {data.fingerprint()} {self.fingerprint()} "
+            f"{self.maxlen}".encode("utf8")
+        ).hexdigest()
+        filenames = [os.path.join(self.cachedir, f"{key}-{n}.npy") for n in names]
+        if all(os.path.exists(f) for f in filenames):
+            return tuple(np.load(f, mmap_mode="r") for f in filenames)
+
+        arrays = encode()
+        for filename, array in zip(filenames, arrays):
+            # write under a temporary name, so other runs never see a partial file
+            with open(filename + ".tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(filename + ".tmp", filename)
+        return arrays
+
+    def __names(self, index):
+        "get key for each code in given index (codes are consecutive from 0)"
+
+        if index not in self.__reverse:
+            codes = getattr(self, index)
+            names = [None] * len(codes)
+            for k, i in codes.items():
+                names[i] = k
+            self.__reverse[index] = names
+
+        return self.__reverse[index]
 
     def __code(self, index, k):
-        "get code for key k in given index, or code for unknown if not found"
+        """
+        get code for key k in given index or, if not found, code for unknown or
+        for its hash bucket (placed after the index codes)
+        """
+
+        if k in index:
+            return index[k]
+        if self.hash_buckets:
+            return len(index) + zlib.crc32(k.encode("utf8")) % self.hash_buckets
+        return index["UNK"]
+
+    def __lookup(self, strings, index):
+        "get code in given index for each string in a data set string table"
+
+        return np.array([self.__code(index, s) for s in strings], dtype=np.int32)
+
+    def __encode(self, data, out):
+        "encode X from given data, also returning the length of each sequence"
 
-        return index[k] if k in index else index["UNK"]
+        if self.cachedir is None:
+            return self.__encode_ids(data, out)
+
+        lengths, X = self.__cached(
+            data, ["lengths", "X"], lambda: self.__encode_ids(data, None)
+        )
+        if out is not None:
+            out = out[:, : len(lengths)]
+            out[...] = X
+            return lengths, out
+        return lengths, X
+
+    def __token_ids(self, data, pairs=None):
+        """
+        get token feature ids of the sequence given pairs are encoded as (or of
+        given sentences, in joint mode)
+        """
 
-    def __encode_and_pad(self, data, index, key):
-        "encode and pad all sequences of given key (form, lemma, etc)"
+        if self.mode == "sdp":
+            return data.path_token_ids(pairs, self.window)
+        if self.mode == "joint":
+            return data.sentence_token_ids(pairs)
+        return data.token_ids(pairs)
+
+    def code_tables(self, data):
+        "get, for each channel, the code of each string in the string table of data"
+
+        with self.__lock:
+            tables = self.__tables.get(data)
+            if tables is None:
+                strings = data.strings()
+                tables = [
+                    self.__lookup(strings, getattr(self, index))
+                    for _, index in CHANNELS
+                ]
+                self.__tables[data] = tables
+            return tables
+
+    def __encode_ids(self, data, out, pairs=None, tables=None):
+        """
+        encode X from the token ids of given data (or the given pairs of it),
+        with the code tables of data (looked up if not given)
+        """
 
-        X = [[self.__code(index, w[key]) for w in s["sent"]] for s in data.sentences()]
-        X = pad_sequences(
-            maxlen=self.maxlen, sequences=X, padding="post", value=index["PAD"]
+        lengths, ids = self.__token_ids(data, pairs)
+        n = len(lengths)
+        if out is None:
+            out = np.empty((len(CHANNELS), n, self.maxlen), dtype=np.int32)
+        out = out[:, :n]
+
+        # position of each token in its padded sequence, negative if cut out
+        ends = np.cumsum(lengths)
+        pair = np.repeat(np.arange(n), lengths)
+        position = np.arange(len(ids)) - np.repeat(
+            ends - np.minimum(lengths, self.maxlen), lengths
         )
-        return X
+        kept = position >= 0
+        pair, position, ids = pair[kept], position[kept], ids[kept]
+
+        if tables is None:
+            tables = self.code_tables(data)
+        for c, (field, index) in enumerate(CHANNELS):
+            out[c].fill(getattr(self, index)["PAD"])
+            out[c, pair, position] = tables[c][ids[:, FIELDS.index(field)]]
+
+        return np.minimum(lengths, self.maxlen), out
+
+    def encode_words(self, data, out=None):
+        """
+        encode X from given data, in a single pass over its tokens. Returns an
+        int32 array per network input, padded (or truncated, keeping the end of
+        longer sentences) to maxlen. An array of shape (len(CHANNELS), >= number
+        of pairs, maxlen) may be given to write them to, instead of a new one
+        """
+
+        _, out = self.__encode(data, out)
+
+        # return encoded sequences, in the order expected by the NN inputs
+        return list(out)
+
+    def encode_buckets(self, data, batch_size, pairs=None):
+        """
+        encode X from given data (or only the given pairs of it) in batches of
+        sequences of similar length, each padded only to the longest sequence in
+        it. Returns a list of the rows (positions in data) in each batch and
+        their encoded sequences
+        """
+
+        lengths, out = self.__encode(data, None)
 
-    def encode_words(self, data):
-        "encode X from given data"
+        rows = np.arange(len(lengths)) if pairs is None else np.asarray(pairs)
+        order = rows[np.argsort(lengths[rows], kind="stable")]
+        buckets = []
+        for start in range(0, len(order), batch_size):
+            rows = order[start : start + batch_size]
+            width = max(lengths[rows[-1]], 1)
+            buckets.append((rows, list(out[:, rows, :width])))
 
-        # encode and pad sentence words
-        Xw = self.__encode_and_pad(data, self.word_index, "form")
-        # encode and pad sentence lc_words
-        Xlw = self.__encode_and_pad(data, self.lc_word_index, "lc_form")
-        # encode and pad lemmas
-        Xl = self.__encode_and_pad(data, self.lemma_index, "lemma")
-        # encode and pad PoS
-        Xp = self.__encode_and_pad(data, self.pos_index, "pos")
+        return buckets
 
-        rel = self.__encode_and_pad(data, self.rel_index, "rel")
+    def encode_sentences(self, data, batch_size, pairs=None):
+        """
+        encode given data (or only the given pairs of it) for a joint model, in
+        batches of batch_size sentences of similar length. Each sentence is
+        encoded once, padded to the longest in its batch, and followed by the
+        positions of the entities of each of its pairs, padded to the most pairs
+        in a sentence of the batch. Returns a list of the pairs (positions in
+        data, -1 for padding) in each batch, its encoded sequences plus entity
+        positions, and the label codes of the pairs. Pairs with an entity not in
+        the encoded sentence (having no token of its own, or cut off by maxlen)
+        cannot be classified, and are left out
+        """
 
-        # return encoded sequences
-        # return [Xw,Xlw,Xl,Xp] (or just the subset expected by the NN inputs)
-        return [Xw, Xlw, rel, Xl, Xp]
-        # return [Xw, Xlw, Xl, Xp]
+        if pairs is None:
+            pairs = np.arange(len(data.pair_types()))
+        pairs = np.asarray(pairs)
+
+        # entity positions in sentences cut to maxlen (keeping their end)
+        full, positions = data.entity_positions(pairs)
+        positions = positions - (full - np.minimum(full, self.maxlen))[:, None]
+        placed = (positions >= 0).all(axis=1)
+        pairs, positions = pairs[placed], positions[placed]
+
+        sentences, inverse = np.unique(data.pair_sentences(pairs), return_inverse=True)
+        lengths, out = self.__encode_ids(data, None, sentences)
+        labels = self.__encode_labels(data, pairs)
+
+        # pairs of each sentence, in data order
+        by_sentence = np.argsort(inverse, kind="stable")
+        counts = np.bincount(inverse, minlength=len(sentences))
+        starts = np.cumsum(counts) - counts
+
+        order = np.argsort(lengths, kind="stable")
+        buckets = []
+        for start in range(0, len(order), batch_size):
+            rows = order[start : start + batch_size]
+            width = max(lengths[rows].max(), 1)
+            P = np.full((len(rows), counts[rows].max()), -1, dtype=np.int64)
+            E = np.zeros(P.shape + (2,), dtype=np.int32)
+            Y = np.zeros(P.shape, dtype=np.int32)
+            for k, s in enumerate(rows.tolist()):
+                members = by_sentence[starts[s] : starts[s] + counts[s]]
+                P[k, : len(members)] = pairs[members]
+                E[k, : len(members)] = positions[members]
+                Y[k, : len(members)] = labels[members]
+            buckets.append((P, list(out[:, rows, :width]) + [E], Y))
+
+        return buckets
 
     def encode_labels(self, data):
-        "encode Y from given data"
+        "encode Y from given data, as an int32 array of label codes"
 
-        # encode and pad sentence labels
-        Y = [self.label_index[s["type"]] for s in data.sentences()]
-        Y = [to_categorical(i, num_classes=self.get_n_labels()) for i in Y]
-        return np.array(Y)
+        return self.__cached(data, ["Y"], lambda: (self.__encode_labels(data),))[0]
+
+    def encode_batch(self, data, pairs, trim=False, tables=None):
+        """
+        encode X and Y for given pairs of data, without using the cache. If trim,
+        sequences are padded only to the longest of them instead of to maxlen.
+        The code tables of data (from code_tables) may be given, to skip
+        looking them up
+        """
+
+        lengths, out = self.__encode_ids(data, None, pairs, tables)
+        if trim:
+            out = out[:, :, : max(lengths.max(initial=0), 1)]
+        return list(out), self.__encode_labels(data, pairs)
+
+    def __encode_labels(self, data, pairs=None):
+        "get label code of each pair in given data (or the given pairs of it)"
+
+        types, inverse = np.unique(data.pair_types(pairs), return_inverse=True)
+        strings = data.strings()
+        codes = [self.label_index[strings[t]] for t in types]
+        return np.array(codes, dtype=np.int32)[inverse]
 
     def get_n_words(self):
         "get word index size"
-        return len(self.word_index)
+        return len(self.word_index) + self.hash_buckets
 
     def get_n_lc_words(self):
         "get word index size"
-        return len(self.lc_word_index)
+        return len(self.lc_word_index) + self.hash_buckets
 
     def get_n_labels(self):
         "get label index size"
@@ -175,15 +447,15 @@ class Codemaps:
 
     def get_n_lemmas(self):
         "get lemmas index size"
-        return len(self.lemma_index)
+        return len(self.lemma_index) + self.hash_buckets
 
     def get_n_pos(self):
         "get pos index size"
-        return len(self.pos_index)
+        return len(self.pos_index) + self.hash_buckets
 
     def get_n_rel(self):
         "get rel index size"
-        return len(self.rel_index)
+        return len(self.rel_index) + self.hash_buckets
 
     def word2idx(self, w):
         "get index for given word"
@@ -200,7 +472,8 @@ class Codemaps:
 
     def idx2label(self, i):
         "get label name for given index"
-        for l in self.label_index:
-            if self.label_index[l] == i:
-                return l
-        raise KeyError
+        return self.__names("label_index")[i]
+
+    def idx2word(self, i):
+        "get word for given index"
+        return self.__names("word_index")[i]
@@ -1,150 +1,751 @@
+import sys
+import pickle
+import hashlib
 from os import listdir
-from xml.dom.minidom import parse
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
 
-import pickle
-from util.deptree import deptree
+import numpy as np
+
+from arraystore import save_arrays, load_arrays, pack_strings, unpack_strings
+from util.ddixml import read_file
+from util.deptree import (
+    parse_all,
+    parser_settings,
+    IntervalIndex,
+    get_cache,
+    get_config,
+    set_config,
+)
+
+
+# how tokens of an entity are shown in a pair: (form, short form) for each role
+MASKS = {
+    "e1": ("<DRUG1>", "<1>"),
+    "e2": ("<DRUG2>", "<2>"),
+    "other": ("<DRUG_OTHER>", "<O>"),
+}
+
+# token features, in the order they are stored. After them, a column with the
+# entity (row in the entities array) the token belongs to, or -1
+FIELDS = ["form", "lc_form", "lemma", "pos", "suffix", "preffix", "rel"]
+ENTITY = len(FIELDS)
+
+# fields where entity tokens show the short form of their mask
+SHORT_MASKED = ["suffix", "preffix", "rel"]
+
+
+def mask_keys(field):
+    "get the keys entity tokens may show in given field, one for each role"
+
+    return [m[1] if field in SHORT_MASKED else m[0] for m in MASKS.values()]
+
+
+# version of the on-disk (.ddi) format. Version 1 data sets, without the
+# dependency path of each pair, can still be loaded
+FORMAT_VERSION = 2
+
+
+def _entity_path(tokens, e1, e2):
+    "get position of the first token of each entity, if any"
+
+    path = []
+    for e in (e1, e2):
+        positions = [k for k, t in enumerate(tokens) if t[4] == e]
+        path.extend(positions[:1])
+    return path
+
+
+def _dependency_path(tree, entities, tokens, e1, e2):
+    """
+    get position of the tokens on the dependency path between the heads of both
+    entities: from e1 up to their lowest common subsumer, and down to e2. If the
+    parse does not allow it, the first token of each entity is given instead
+    """
+
+    heads = [
+        tree.get_fragment_head(entities[e]["start"], entities[e]["end"])
+        for e in (e1, e2)
+    ]
+    if None in heads:
+        return _entity_path(tokens, e1, e2)
+
+    lcs = tree.get_LCS(*heads)
+    if lcs is None:
+        return _entity_path(tokens, e1, e2)
+    up = tree.get_up_path(heads[0], lcs)
+    down = tree.get_down_path(lcs, heads[1])
+    if up is None or down is None:
+        return _entity_path(tokens, e1, e2)
+
+    # tree nodes are numbered from 1, token positions from 0
+    return [n - 1 for n in up + [lcs] + down]
+
+
+def _parse_files(datadir, files):
+    """
+    parse given XML files in datadir. Returns, for each file, the list of its
+    sentences with entity pairs, as (sid, entities, tokens, pairs), where each
+    pair is (e1, e2, type, dependency path)
+    """
+
+    # read sentences with entity pairs from each file
+    docs = []
+    for f in files:
+        doc = []
+        for s in read_file(datadir + "/" + f):
+            # there are no entity pairs, skip sentence
+            if len(s["entities"]) <= 1:
+                continue
+
+            entities = {}
+            for e in s["entities"]:
+                # for discontinuous entities, we only get the first span
+                # (will not work, but there are few of them)
+                (start, end) = e["charOffset"].split(";")[0].split("-")
+                entities[e["id"]] = {
+                    "start": int(start),
+                    "end": int(end),
+                    "type": e["type"],
+                }
+
+            doc.append((s["id"], s["text"], entities, s["pairs"]))
+        docs.append(doc)
+
+    # analyze all sentences with stanford parser (concurrently, and a
+    # document per request, if configured).
+    trees = parse_all([[stext for (_, stext, _, _) in doc] for doc in docs])
+
+    parsed = []
+    for doc, doc_trees in zip(docs, trees):
+        file_sentences = []
+        for (sid, stext, entities, pairs), tree in zip(doc, doc_trees):
+            # sentence tokens, and the entity each of them belongs to
+            index = IntervalIndex.of_entities(entities)
+            tokens = []
+            for tk in range(1, tree.get_n_nodes()):
+                tokens.append(
+                    (
+                        tree.get_word(tk),
+                        tree.get_lemma(tk),
+                        tree.get_tag(tk),
+                        tree.get_rel(tk),
+                        tree.is_entity(tk, index),
+                    )
+                )
+
+            # for each pair in the sentence, get whether it is DDI and its type
+            ddis = []
+            for p in pairs:
+                # ground truth
+                if p["ddi"] == "true":
+                    dditype = p["type"]
+                else:
+                    dditype = "null"
+                # target entities, and the path between them
+                path = _dependency_path(tree, entities, tokens, p["e1"], p["e2"])
+                ddis.append((p["e1"], p["e2"], dditype, path))
+
+            file_sentences.append((sid, entities, tokens, ddis))
+        parsed.append(file_sentences)
+
+    return parsed
+
+
+def _parse_shard(datadir, files):
+    "parse files in a worker process, returning also its parse cache counts"
+
+    cache = get_cache()
+    return _parse_files(datadir, files), cache.take_counts() if cache else None
+
+
+def _parse_parallel(datadir, files, workers):
+    "parse XML files with a pool of processes, merging results in the given order"
+
+    # several shards per worker, so they end at about the same time
+    size = max(1, -(-len(files) // (workers * 4)))
+    shards = [files[i : i + size] for i in range(0, len(files), size)]
+
+    parsed = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=get_context("spawn"),
+        initializer=set_config,
+        initargs=(get_config(),),
+    ) as pool:
+        for shard, counts in pool.map(_parse_shard, [datadir] * len(shards), shards):
+            parsed.extend(shard)
+            if counts is not None:
+                get_cache().add_counts(counts)
+
+    return parsed
+
+
+class _Builder:
+    """
+    Accumulate sentences and pairs, interning all their strings, and pack
+    them into the arrays a Dataset is made of.
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+        for mask, short in MASKS.values():
+            self.intern(mask)
+            self.intern(short)
+
+        self.sent_ids = []
+        self.sent_tokens = [0]
+        self.sent_entities = [0]
+        self.tokens = []
+        self.entities = []
+        self.pairs = []
+        self.paths = []
+        self.path_offsets = [0]
+
+    def intern(self, s):
+        "get id of given string in the string table, adding it if needed"
+
+        i = self.index.get(s)
+        if i is None:
+            i = self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def add_sentence(self, sid, entities, tokens):
+        """
+        add a sentence, given its entities {id: {"start", "end", "type"}} and its
+        tokens [(form, lemma, pos, rel, entity id or None)]. Returns its row
+        """
+
+        rows = {}
+        for eid, e in entities.items():
+            rows[eid] = len(self.entities)
+            self.entities.append(
+                (self.intern(eid), self.intern(e["type"]), e["start"], e["end"])
+            )
+
+        intern = self.intern
+        for form, lemma, pos, rel, ent in tokens:
+            self.tokens.append(
+                (
+                    intern(form),
+                    intern(form.lower()),
+                    intern(lemma),
+                    intern(pos),
+                    intern(form[-3:]),
+                    intern(form[:3]),
+                    intern(rel),
+                    rows[ent] if ent is not None else -1,
+                )
+            )
+
+        self.sent_ids.append(intern(sid))
+        self.sent_tokens.append(len(self.tokens))
+        self.sent_entities.append(len(self.entities))
+        return len(self.sent_ids) - 1
+
+    def add_pair(self, row, e1, e2, dditype, path):
+        """
+        add a pair of entities in the sentence at given row, with the positions
+        of the tokens in the dependency path between them
+        """
+
+        self.pairs.append((row, self.intern(e1), self.intern(e2), self.intern(dditype)))
+        self.paths.extend(path)
+        self.path_offsets.append(len(self.paths))
+
+    def arrays(self):
+        "pack everything added so far into arrays"
+
+        strings, string_offsets = pack_strings(self.strings)
+        return {
+            "strings": strings,
+            "string_offsets": string_offsets,
+            "sent_ids": np.array(self.sent_ids, dtype=np.int32),
+            "sent_tokens": np.array(self.sent_tokens, dtype=np.int64),
+            "sent_entities": np.array(self.sent_entities, dtype=np.int64),
+            "tokens": np.array(self.tokens, dtype=np.int32).reshape(-1, ENTITY + 1),
+            "entities": np.array(self.entities, dtype=np.int32).reshape(-1, 4),
+            "pairs": np.array(self.pairs, dtype=np.int32).reshape(-1, 4),
+            "paths": np.array(self.paths, dtype=np.int32),
+            "path_offsets": np.array(self.path_offsets, dtype=np.int64),
+        }
 
 
 class Dataset:
     """
-    Parse all XML files in given dir, and load a list of sentences.
-    Each sentence is a list of tuples (word, start, end, tag)
+    Parse all XML files in given dir (with the given number of processes),
+    and load a list of sentences.
+    Sentences are stored once, in columnar form: int32 arrays of tokens (ids in an
+    interned string table), entities and (sentence, e1, e2, type) pairs, saved as
+    a directory of .npy files that is memory-mapped when loaded. Records for each
+    pair, with its target entities masked, are built on demand.
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, workers=1, previous=None):
+
+        self.__strings = None
+        self.__kept = None
+        self.__fingerprint = None
+        # for data sets parsed from XML files: hash of each of them and the slice
+        # of sentences and pairs coming from it
+        self.manifest = None
+
+        if filename.endswith(".ddi"):
+            # parameter is a saved data set, memory-map it
+            self.arrays, meta = load_arrays(filename)
+            if meta.get("version") not in (1, FORMAT_VERSION):
+                raise ValueError(filename + ": unsupported data set format")
+            self.manifest = meta.get("manifest")
 
-        if filename.endswith(".pck"):
-            # parameter is a pickle file, load it
+        elif filename.endswith(".pck"):
+            # parameter is a pickle file from older versions, load and convert it
             with open(filename, "rb") as pf:
-                self.data = pickle.load(pf)
+                self.arrays = self.__convert(pickle.load(pf))
+
+        else:
+            # parameter must be a folder with XML data, load it (reusing what
+            # a previous version of the data set has for unchanged files)
+            self.arrays = self.__parse(filename, workers, previous)
+
+    def __parse(self, datadir, workers, previous):
+        """
+        parse XML files in given dir, sharding them across worker processes.
+        Files whose hash is in the manifest of given previous data set are not
+        parsed again, their sentences are copied from it instead
+        """
+
+        files = listdir(datadir)
+        hashes = {}
+        for f in files:
+            with open(datadir + "/" + f, "rb") as xf:
+                hashes[f] = hashlib.sha256(xf.read()).hexdigest()
 
+        reused = {}
+        known = set()
+        if previous is not None and previous.manifest is not None:
+            known = {m["file"] for m in previous.manifest["files"]}
+            # (version 1 data sets have no dependency paths to reuse)
+            if (
+                previous.manifest["settings"] == parser_settings()
+                and "paths" in previous.arrays
+            ):
+                for m in previous.manifest["files"]:
+                    if hashes.get(m["file"]) == m["hash"]:
+                        reused[m["file"]] = m
+
+        todo = [f for f in files if f not in reused]
+        if workers <= 1:
+            parsed = _parse_files(datadir, todo)
         else:
-            # parameter must be a folder with XML data, load it
-            self.data = []
-
-            # process each file in directory
-            for f in listdir(filename):
-
-                # parse XML file, obtaining a DOM tree
-                tree = parse(filename + "/" + f)
-
-                # process each sentence in the file
-                sentences = tree.getElementsByTagName("sentence")
-                for s in sentences:
-                    sid = s.attributes["id"].value  # get sentence id
-                    stext = s.attributes["text"].value  # get sentence text
-                    ents = s.getElementsByTagName("entity")
-
-                    # there are no entity pairs, skip sentence
-                    if len(ents) <= 1:
-                        continue
-
-                    entities = {}
-                    for e in ents:
-                        # for discontinuous entities, we only get the first span
-                        # (will not work, but there are few of them)
-                        eid = e.attributes["id"].value
-                        typ = e.attributes["type"].value
-                        (start, end) = (
-                            e.attributes["charOffset"].value.split(";")[0].split("-")
-                        )
-                        entities[eid] = {
-                            "start": int(start),
-                            "end": int(end),
-                            "type": typ,
-                        }
-
-                    # analyze sentence with stanford parser.
-                    tree = deptree(stext)
-
-                    # for each pair in the sentence, get whether it is DDI and its type
-                    pairs = s.getElementsByTagName("pair")
-                    for p in pairs:
-                        # ground truth
-                        ddi = p.attributes["ddi"].value
-                        if ddi == "true":
-                            dditype = p.attributes["type"].value
-                        else:
-                            dditype = "null"
-                        # target entities
-                        e1 = p.attributes["e1"].value
-                        e2 = p.attributes["e2"].value
-
-                        sent = []
-                        seen = set([])
-                        for tk in range(1, tree.get_n_nodes()):
-                            tk_start, tk_end = tree.get_offset_span(tk)
-                            tk_ent = tree.is_entity(tk, entities)
-
-                            if tk_ent is None:
-                                token = {
-                                    "form": tree.get_word(tk),
-                                    "lc_form": tree.get_word(tk).lower(),
-                                    "lemma": tree.get_lemma(tk),
-                                    "pos": tree.get_tag(tk),
-                                    "suffix": tree.get_word(tk)[-3:],
-                                    "preffix": tree.get_word(tk)[:3],
-                                    "rel": tree.get_rel(tk),
-                                }
-                            elif tk_ent == e1:
-                                token = {
-                                    "form": "<DRUG1>",
-                                    "lc_form": "<DRUG1>",
-                                    "lemma": "<DRUG1>",
-                                    "pos": "<DRUG1>",
-                                    "suffix": "<1>",
-                                    "preffix": "<1>",
-                                    "rel": "<1>",
-                                    "etype": entities[e1]["type"],
-                                }
-                            elif tk_ent == e2:
-                                token = {
-                                    "form": "<DRUG2>",
-                                    "lc_form": "<DRUG2>",
-                                    "lemma": "<DRUG2>",
-                                    "pos": "<DRUG2>",
-                                    "suffix": "<2>",
-                                    "preffix": "<2>",
-                                    "rel": "<2>",
-                                    "etype": entities[e2]["type"],
-                                }
-                            else:
-                                token = {
-                                    "form": "<DRUG_OTHER>",
-                                    "lc_form": "<DRUG_OTHER>",
-                                    "lemma": "<DRUG_OTHER>",
-                                    "pos": "<DRUG_OTHER>",
-                                    "suffix": "<O>",
-                                    "preffix": "<O>",
-                                    "rel": "<O>",
-                                    "etype": entities[tk_ent]["type"],
-                                }
-
-                            if tk_ent is None or tk_ent not in seen:
-                                sent.append(token)
-                            if tk_ent is not None:
-                                seen.add(tk_ent)
-
-                        # resulting vector
-                        self.data.append(
-                            {
-                                "sid": sid,
-                                "e1": e1,
-                                "e2": e2,
-                                "type": dditype,
-                                "sent": sent,
-                            }
-                        )
+            parsed = _parse_parallel(datadir, todo, workers)
+        parsed = dict(zip(todo, parsed))
+
+        if previous is not None:
+            new = len([f for f in todo if f not in known])
+            print(
+                "dataset: {} files unchanged, {} changed, {} new, {} removed".format(
+                    len(reused), len(todo) - new, new, len(known - set(files))
+                ),
+                file=sys.stderr,
+            )
+
+        builder = _Builder()
+        files_manifest = []
+        for f in files:
+            if f in reused:
+                file_sentences = previous.__file_sentences(reused[f])
+            else:
+                file_sentences = parsed[f]
+
+            first_sentence, first_pair = len(builder.sent_ids), len(builder.pairs)
+            for sid, entities, tokens, pairs in file_sentences:
+                row = builder.add_sentence(sid, entities, tokens)
+                for e1, e2, dditype, path in pairs:
+                    builder.add_pair(row, e1, e2, dditype, path)
+
+            files_manifest.append(
+                {
+                    "file": f,
+                    "hash": hashes[f],
+                    "sentences": [first_sentence, len(builder.sent_ids)],
+                    "pairs": [first_pair, len(builder.pairs)],
+                }
+            )
+
+        self.manifest = {"settings": parser_settings(), "files": files_manifest}
+        return builder.arrays()
+
+    def __file_sentences(self, entry):
+        """
+        get back the sentences of a file in the manifest, as (sid, entities,
+        tokens, pairs) like they are parsed
+        """
+
+        strings = self.strings()
+        entities_rows = self.arrays["entities"]
+
+        # pairs in the file, by sentence
+        (first, last) = entry["pairs"]
+        pairs = {}
+        paths, path_offsets = self.arrays["paths"], self.arrays["path_offsets"]
+        for p, (row, e1, e2, dditype) in enumerate(
+            self.arrays["pairs"][first:last].tolist(), first
+        ):
+            path = paths[path_offsets[p] : path_offsets[p + 1]].tolist()
+            pairs.setdefault(row, []).append(
+                (strings[e1], strings[e2], strings[dditype], path)
+            )
+
+        sentences = []
+        (first, last) = entry["sentences"]
+        for row in range(first, last):
+            start, end = self.arrays["sent_entities"][row : row + 2]
+            entities = {}
+            for eid, etype, e_start, e_end in entities_rows[start:end].tolist():
+                entities[strings[eid]] = {
+                    "start": e_start,
+                    "end": e_end,
+                    "type": strings[etype],
+                }
+
+            start, end = self.arrays["sent_tokens"][row : row + 2]
+            tokens = []
+            for token in self.arrays["tokens"][start:end].tolist():
+                # lc_form, suffix and preffix are derived again from form
+                form, _, lemma, pos, _, _, rel, ent = token
+                tokens.append(
+                    (
+                        strings[form],
+                        strings[lemma],
+                        strings[pos],
+                        strings[rel],
+                        strings[entities_rows[ent][0]] if ent >= 0 else None,
+                    )
+                )
+
+            sentences.append(
+                (
+                    strings[self.arrays["sent_ids"][row]],
+                    entities,
+                    tokens,
+                    pairs.get(row, []),
+                )
+            )
+
+        return sentences
+
+    def __convert(self, data):
+        """
+        convert data loaded from pickle files written by older versions. They
+        have no parse trees, so the path of each pair is just its entities
+        """
+
+        builder = _Builder()
+
+        # sentences stored once, and pairs on them
+        if isinstance(data, dict):
+            rows = {}
+            for sid, s in data["sentences"].items():
+                rows[sid] = builder.add_sentence(sid, s["entities"], s["tokens"])
+            for sid, e1, e2, dditype in data["pairs"]:
+                path = _entity_path(data["sentences"][sid]["tokens"], e1, e2)
+                builder.add_pair(rows[sid], e1, e2, dditype, path)
+            return builder.arrays()
+
+        # list of already masked pairs. Each of them becomes a sentence, where
+        # masked tokens are the (only) token of an entity of the same role
+        for r in data:
+            entities = {}
+            tokens = []
+            for k, t in enumerate(r["sent"]):
+                ent = None
+                if "etype" in t:
+                    if t["form"] == MASKS["e1"][0]:
+                        ent = r["e1"]
+                    elif t["form"] == MASKS["e2"][0]:
+                        ent = r["e2"]
+                    else:
+                        ent = "<other " + str(k) + ">"
+                    entities[ent] = {"start": -1, "end": -1, "type": t["etype"]}
+                tokens.append((t["form"], t["lemma"], t["pos"], t["rel"], ent))
+            row = builder.add_sentence(r["sid"], entities, tokens)
+            path = _entity_path(tokens, r["e1"], r["e2"])
+            builder.add_pair(row, r["e1"], r["e2"], r["type"], path)
+
+        return builder.arrays()
 
     def save(self, filename):
-        "save data set to a pickle file"
+        "save data set to a directory of .npy files"
+
+        if not filename.endswith(".ddi"):
+            filename += ".ddi"
+
+        save_arrays(
+            filename,
+            {"version": FORMAT_VERSION, "manifest": self.manifest},
+            self.arrays,
+        )
+
+    def strings(self):
+        "get string table, tokens and pairs refer to strings by their position in it"
+
+        if self.__strings is None:
+            self.__strings = unpack_strings(
+                self.arrays["strings"], self.arrays["string_offsets"]
+            )
+        return self.__strings
+
+    def fingerprint(self):
+        "get hash of the data set contents, the same wherever it was loaded from"
+
+        if self.__fingerprint is None:
+            h = hashlib.sha256()
+            for name in sorted(self.arrays):
+                array = np.ascontiguousarray(self.arrays[name])
+                h.update(f"{name} {array.dtype} {array.shape}".encode("utf8"))
+                h.update(array.data)
+            self.__fingerprint = h.hexdigest()
+        return self.__fingerprint
+
+    def __pair(self, row, e1, e2, dditype):
+        "build record for given pair, masking its target entities and any other one"
+
+        strings = self.strings()
+        start, end = self.arrays["sent_tokens"][row : row + 2]
+
+        sent = []
+        seen = set([])
+        for token in self.arrays["tokens"][start:end].tolist():
+            ent = token[ENTITY]
+            if ent < 0:
+                sent.append({f: strings[i] for f, i in zip(FIELDS, token)})
+
+            # only the first token of each entity is kept
+            elif ent not in seen:
+                seen.add(ent)
+                eid, etype = self.arrays["entities"][ent, :2].tolist()
+                mask, short = MASKS[
+                    "e1" if eid == e1 else "e2" if eid == e2 else "other"
+                ]
+                sent.append(
+                    {
+                        "form": mask,
+                        "lc_form": mask,
+                        "lemma": mask,
+                        "pos": mask,
+                        "suffix": short,
+                        "preffix": short,
+                        "rel": short,
+                        "etype": strings[etype],
+                    }
+                )
+
+        # resulting vector
+        return {
+            "sid": strings[self.arrays["sent_ids"][row]],
+            "e1": strings[e1],
+            "e2": strings[e2],
+            "type": strings[dditype],
+            "sent": sent,
+        }
+
+    def __kept_tokens(self):
+        """
+        get tokens shown in pair records (those not in an entity, and the first one
+        of each entity), and where those of each sentence start
+        """
+
+        if self.__kept is None:
+            sent_tokens = self.arrays["sent_tokens"]
+            ents = self.arrays["tokens"][:, ENTITY]
+
+            kept = ents < 0
+            # entity rows are not shared between sentences
+            _, first = np.unique(ents, return_index=True)
+            kept[first[ents[first] >= 0]] = True
+            kept = np.flatnonzero(kept)
 
-        if not filename.endswith(".pck"):
-            filename += ".pck"
+            # number of kept tokens in each sentence
+            sentence = np.repeat(np.arange(len(sent_tokens) - 1), np.diff(sent_tokens))
+            counts = np.bincount(sentence[kept], minlength=len(sent_tokens) - 1)
+            self.__kept = kept, np.concatenate([[0], np.cumsum(counts)])
 
-        with open(filename, "wb") as pf:
-            pickle.dump(self.data, pf)
+        return self.__kept
+
+    def pair_types(self, pairs=None):
+        "get string id of the DDI type of given pairs (all of them by default)"
+
+        selected = self.arrays["pairs"]
+        if pairs is not None:
+            selected = selected[pairs]
+        return selected[:, 3]
+
+    def pair_sentences(self, pairs=None):
+        "get row of the sentence of given pairs (all of them by default)"
+
+        selected = self.arrays["pairs"]
+        if pairs is not None:
+            selected = selected[pairs]
+        return selected[:, 0]
+
+    def pair_entities(self, pairs=None):
+        """
+        get entity row (in the entities array) of e1 and e2 of given pairs (all
+        of them by default)
+        """
+
+        selected = self.arrays["pairs"]
+        if pairs is not None:
+            selected = selected[pairs]
+        entities = self.arrays["entities"]
+        sent_entities = self.arrays["sent_entities"]
+
+        rows = np.zeros((len(selected), 2), dtype=np.int64)
+        for p, (row, e1, e2, _) in enumerate(selected.tolist()):
+            start, end = sent_entities[row : row + 2]
+            eids = entities[start:end, 0].tolist()
+            rows[p] = start + eids.index(e1), start + eids.index(e2)
+        return rows
+
+    def entity_positions(self, pairs=None):
+        """
+        get position of e1 and e2 of given pairs (all of them by default) in the
+        records of their sentences built by sentence_token_ids, -1 for entities
+        with no token of their own. Returns also the length of those records
+        """
+
+        kept, offsets = self.__kept_tokens()
+        ents = self.arrays["tokens"][kept, ENTITY]
+        sentence = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        position = np.arange(len(kept)) - offsets[sentence]
+
+        first = np.full(len(self.arrays["entities"]), -1, dtype=np.int64)
+        first[ents[ents >= 0]] = position[ents >= 0]
+
+        rows = self.pair_sentences(pairs)
+        return offsets[rows + 1] - offsets[rows], first[self.pair_entities(pairs)]
+
+    def sentence_token_ids(self, rows=None):
+        """
+        get string ids of token features (in FIELDS order) of given sentences
+        (all of them by default), shown as in pair records but with every entity
+        masked as other drug, so one record serves all pairs in the sentence.
+        Returns the length of each record, and an int32 array with a row per
+        token of all records
+        """
+
+        kept, offsets = self.__kept_tokens()
+        if rows is None:
+            rows = np.arange(len(offsets) - 1)
+
+        lengths = offsets[rows + 1] - offsets[rows]
+        position = np.arange(lengths.sum()) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+        tokens = self.arrays["tokens"][
+            kept[np.repeat(offsets[rows], lengths) + position]
+        ]
+
+        # no entity is e1 or e2
+        none = np.full((len(tokens), 4), -1, dtype=np.int32)
+        return lengths, self.__masked_ids(tokens, none)
+
+    def token_ids(self, pairs=None):
+        """
+        get string ids of token features (in FIELDS order) of given pairs (all of
+        them by default), as sentences() shows them. Returns the length of each
+        pair record, and an int32 array with a row per token of all records
+        """
+
+        selected = self.arrays["pairs"]
+        if pairs is not None:
+            selected = selected[pairs]
+        kept, offsets = self.__kept_tokens()
+
+        # position of each token in its pair record, and in kept tokens
+        rows = selected[:, 0]
+        lengths = offsets[rows + 1] - offsets[rows]
+        pair = np.repeat(np.arange(len(selected)), lengths)
+        position = np.arange(lengths.sum()) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+        tokens = self.arrays["tokens"][kept[offsets[rows][pair] + position]]
+
+        return lengths, self.__masked_ids(tokens, selected[pair])
+
+    def path_token_ids(self, pairs=None, window=0):
+        """
+        get string ids of token features (in FIELDS order) of given pairs (all of
+        them by default), for the tokens in the dependency path between the
+        entities, in path order (from e1 up to their lowest common ancestor, then
+        down to e2). With a window, up to that many tokens preceding the first
+        path token in the sentence go before them, and up to that many following
+        the last one go after them, in sentence order (skipping entity tokens
+        but the first, as sentence records do). Returns the length of each pair
+        record, and an int32 array with a row per token of all records.
+
+        Records longer than the codemaps maxlen keep their end when encoded, so
+        long paths lose their e1 side
+        """
+
+        if "paths" not in self.arrays:
+            raise ValueError("data set has no dependency paths, parse it again")
+
+        indexes = np.arange(len(self.arrays["pairs"]))
+        if pairs is not None:
+            indexes = indexes[pairs]
+        selected = self.arrays["pairs"][indexes]
+        sent_tokens = self.arrays["sent_tokens"]
+        paths, path_offsets = self.arrays["paths"], self.arrays["path_offsets"]
+
+        # tokens shown in sentence records, to take window tokens from
+        shown = np.zeros(len(self.arrays["tokens"]), dtype=bool)
+        shown[self.__kept_tokens()[0]] = True
+
+        positions = []
+        lengths = np.zeros(len(selected), dtype=np.int64)
+        for k, (p, row) in enumerate(zip(indexes.tolist(), selected[:, 0].tolist())):
+            path = paths[path_offsets[p] : path_offsets[p + 1]]
+            if len(path) > 0 and window > 0:
+                # path order is not sentence order, take context around its span
+                first, last = path.min(), path.max()
+                sent = shown[sent_tokens[row] : sent_tokens[row + 1]]
+                before = np.flatnonzero(sent[:first])[-window:]
+                after = last + 1 + np.flatnonzero(sent[last + 1 :])[:window]
+                path = np.concatenate([before, path, after])
+            positions.append(sent_tokens[row] + path)
+            lengths[k] = len(path)
+
+        positions = np.concatenate(positions) if positions else np.zeros(0, np.int64)
+        tokens = self.arrays["tokens"][positions]
+        pair = np.repeat(np.arange(len(selected)), lengths)
+
+        return lengths, self.__masked_ids(tokens, selected[pair])
+
+    def __masked_ids(self, tokens, pairs):
+        """
+        get token feature ids of given token rows, masking those in an entity
+        according to its role in the pair (given for each token) they are shown in
+        """
+
+        ids = np.array(tokens[:, :ENTITY], dtype=np.int32)
+        ents = tokens[:, ENTITY]
+        eids = np.where(ents >= 0, self.arrays["entities"][ents, 0], -1)
+
+        # mask entities, according to their role in the pair
+        e1 = (ents >= 0) & (eids == pairs[:, 1])
+        e2 = (ents >= 0) & ~e1 & (eids == pairs[:, 2])
+        other = (ents >= 0) & ~e1 & ~e2
+        strings = self.strings()
+        for role, masked in (("e1", e1), ("e2", e2), ("other", other)):
+            mask, short = (strings.index(m) for m in MASKS[role])
+            ids[masked] = [short if f in SHORT_MASKED else mask for f in FIELDS]
+
+        return ids
 
     def sentences(self):
         "iterator to get sentences in the data set"
-        return iter(self.data)
+
+        return (self.__pair(*p) for p in self.arrays["pairs"].tolist())
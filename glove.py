@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+
+import numpy as np
+
+from arraystore import save_arrays, load_arrays, pack_strings, unpack_strings
+
+# GloVe vectors converted once from their text file to a float32 matrix plus a
+# word table, so building a network does not need to parse text again.
+
+
+def convert(txtfile, dirname):
+    "convert GloVe text file to a directory with its vectors and words"
+
+    words = []
+    vectors = []
+    with open(txtfile, "r") as f:
+        for line in f:
+            word, values = line.rstrip().split(" ", 1)
+            words.append(word)
+            vectors.append(np.array(values.split(), dtype=np.float32))
+
+    data, offsets = pack_strings(words)
+    save_arrays(
+        dirname,
+        {"source": os.path.basename(txtfile)},
+        {"vectors": np.stack(vectors), "words": data, "word_offsets": offsets},
+    )
+
+
+def load(dirname):
+    "load GloVe words and (memory-mapped) vectors from a converted directory"
+
+    arrays, _ = load_arrays(dirname)
+    return unpack_strings(arrays["words"], arrays["word_offsets"]), arrays["vectors"]
+
+
+def embedding_matrices(dirname, indexes):
+    """
+    get GloVe embedding matrix for each of given (key to code index, number of
+    codes) pairs. Codes of keys without a vector (and past the index) get zeros
+    """
+
+    words, vectors = load(dirname)
+    row = {w: i for i, w in enumerate(words)}
+
+    # gather vectors for the keys of all indexes at once
+    codes = [np.fromiter(index.values(), dtype=np.int64) for index, _ in indexes]
+    rows = np.array(
+        [row.get(k, -1) for index, _ in indexes for k in index], dtype=np.int64
+    )
+    gathered = vectors[np.maximum(rows, 0)]
+    gathered[rows < 0] = 0
+
+    matrices = []
+    ends = np.cumsum([len(index) for index, _ in indexes])
+    for (_, n_codes), c, found in zip(indexes, codes, np.split(gathered, ends[:-1])):
+        matrix = np.zeros((n_codes, vectors.shape[1]), dtype=np.float32)
+        matrix[c] = found
+        matrices.append(matrix)
+
+    return matrices
+
+
+# --------- MAIN PROGRAM -----------
+# --
+# -- Usage:  glove.py glove.6B.100d.txt glove.6B.100d.glove
+# --
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        print("Usage: glove.py <txtfile> <dirname>")
+        exit(1)
+
+    convert(sys.argv[1], sys.argv[2])
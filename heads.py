@@ -0,0 +1,69 @@
+import tensorflow as tf
+from tensorflow.keras import layers
+
+# Ways of summarizing a sequence of token states into the vector the network
+# classifies each pair from.
+
+HEADS = ["flatten", "max", "mean", "attention", "entity"]
+
+
+class MaskedPooling(layers.Layer):
+    "max or mean pooling over the positions selected by a boolean tensor"
+
+    def __init__(self, mode="max"):
+        super(MaskedPooling, self).__init__()
+        self.mode = mode
+
+    def call(self, inputs, positions):
+        selected = tf.cast(positions, inputs.dtype)[:, :, tf.newaxis]
+        if self.mode == "max":
+            # sequences with no position selected get zeros
+            masked = tf.where(selected > 0, inputs, inputs.dtype.min)
+            return tf.reduce_max(masked, axis=1) * tf.reduce_max(selected, axis=1)
+        total = tf.reduce_sum(inputs * selected, axis=1)
+        return total / tf.maximum(tf.reduce_sum(selected, axis=1), 1)
+
+
+class AttentionPooling(layers.Layer):
+    "weighted sum of the states at selected positions, with learned weights"
+
+    def __init__(self):
+        super(AttentionPooling, self).__init__()
+        self.score = layers.Dense(1)
+
+    def call(self, inputs, positions):
+        scores = tf.squeeze(self.score(inputs), axis=-1)
+        scores = tf.where(positions, scores, -1e9)
+        weights = tf.nn.softmax(scores, axis=1)[:, :, tf.newaxis]
+        return tf.reduce_sum(inputs * weights, axis=1)
+
+
+class PairPooling(layers.Layer):
+    """
+    states of the two entities of each pair (batch, pairs, 2 * dim), from the
+    token states of its sentence and entity positions (batch, pairs, 2)
+    """
+
+    def call(self, inputs, positions):
+        pairs = tf.gather(inputs, positions, batch_dims=1)
+        return tf.concat([pairs[:, :, 0], pairs[:, :, 1]], axis=-1)
+
+
+def build_head(name, states, mask, words=None, markers=None):
+    """
+    summarize states (batch, length, dim) of tokens where mask is true with the
+    named head. The entity head pools states at the positions where words (the
+    word input) equals each of the given marker codes, concatenating results
+    """
+
+    if name == "flatten":
+        return layers.Flatten()(states)
+    elif name in ("max", "mean"):
+        return MaskedPooling(name)(states, mask)
+    elif name == "attention":
+        return AttentionPooling()(states, mask)
+    elif name == "entity":
+        return layers.Concatenate()(
+            [MaskedPooling("max")(states, tf.equal(words, m)) for m in markers]
+        )
+    raise ValueError(f"unknown head: {name}")
@@ -0,0 +1,75 @@
+import tensorflow as tf
+from tensorflow.keras.layers import (
+    Dense,
+    Conv1D,
+    Bidirectional,
+    LSTM,
+)
+
+from transformer import TransformerBlock
+
+# Encoders turning the concatenated token embeddings (batch, length, dim) into
+# token states (batch, length, units) for a head to summarize. Padding
+# positions are where mask is false (mask is None when there is no padding to
+# ignore, such as for the flatten head).
+
+# name of the network input for each Codemaps channel, in the same order
+INPUTS = ["input_w", "input_lw", "input_rel", "input_l", "input_p"]
+
+ARCHITECTURES = {}
+
+
+def architecture(name):
+    "register decorated function as the encoder with given name"
+
+    def register(encoder):
+        ARCHITECTURES[name] = encoder
+        return encoder
+
+    return register
+
+
+def masked(states, mask):
+    "zero states at padding positions"
+
+    if mask is None:
+        return states
+    return states * tf.cast(mask, states.dtype)[:, :, tf.newaxis]
+
+
+@architecture("bilstm")
+def bilstm(x, mask):
+    return Bidirectional(LSTM(units=128, return_sequences=True))(x, mask=mask)
+
+
+@architecture("cnn")
+def cnn(x, mask):
+    for width in (3, 5):
+        x = Conv1D(256, width, padding="same", activation="relu")(masked(x, mask))
+    return masked(x, mask)
+
+
+@architecture("cnn-small")
+def cnn_small(x, mask):
+    x = Conv1D(64, 3, padding="same", activation="relu")(masked(x, mask))
+    return masked(x, mask)
+
+
+@architecture("transformer")
+def transformer(x, mask):
+    x = Dense(128)(x)
+    for _ in range(2):
+        x = TransformerBlock(embed_dim=128, num_heads=4, ff_dim=256)(x, mask=mask)
+    return x
+
+
+@architecture("cnn-bilstm")
+def cnn_bilstm(x, mask):
+    x = Conv1D(256, 3, padding="same", activation="relu")(masked(x, mask))
+    return bilstm(x, mask)
+
+
+@architecture("bilstm-transformer")
+def bilstm_transformer(x, mask):
+    x = bilstm(x, mask)
+    return TransformerBlock(embed_dim=256, num_heads=4, ff_dim=256)(x, mask=mask)
@@ -2,20 +2,91 @@
 
 
 import sys
+import os
+import argparse
 from dataset import Dataset
+from util.deptree import set_pool, set_cache
 
-# preprocess a dataset with StanfordCore, and store it in a pickle file for later use
-# usage:  ./parse_data.py data-folder filename
-#   e.g.  ./parse_data.py ../../data/train train
+# preprocess a dataset with StanfordCore, and store it (as a .ddi directory) for later use.
+# if the output already exists, only files added or changed since are parsed
+# usage:  ./parse_data.py [--batch] [--workers N] [--threads N] [--cache FILE] data-folder filename
+#   e.g.  ./parse_data.py --batch --workers 4 --threads 8 --cache parse.cache ../../data/train train
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("usage: ./parse_data.py <data-folder> <filename>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description="preprocess a dataset with StanfordCore and store it for later use"
+    )
+    parser.add_argument("datadir", help="folder with XML data")
+    parser.add_argument(
+        "filename", help="output data set (.ddi is appended if missing)"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="number of requests in flight to the CoreNLP server (default: 1)",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="send all sentences of a document in a single request",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes the XML files are split across (default: 1), "
+        "each of them with its own --threads requests in flight",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="timeout in seconds for each request (default: 60)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="times a failed request is retried (default: 3)",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="FILE",
+        help="persistent cache of parsed sentences, reused across runs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1000000,
+        help="maximum number of sentences kept in the cache (default: 1000000)",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="parse all files, even if an existing output data set has them unchanged",
+    )
+    args = parser.parse_args()
 
-    datadir = sys.argv[1]
-    filename = sys.argv[2]
+    set_pool(
+        threads=args.threads,
+        timeout=args.timeout,
+        retries=args.retries,
+        batch=args.batch,
+    )
+    cache = set_cache(args.cache, args.cache_size)
 
-    data = Dataset(datadir)
+    # reuse sentences of unchanged files from the existing data set, if any
+    filename = (
+        args.filename if args.filename.endswith(".ddi") else args.filename + ".ddi"
+    )
+    previous = None
+    if not args.rebuild and os.path.exists(filename + "/meta.json"):
+        previous = Dataset(filename)
+
+    data = Dataset(args.datadir, workers=args.workers, previous=previous)
     data.save(filename)
 
+    if cache is not None:
+        print(cache.stats(), file=sys.stderr)
+        cache.close()
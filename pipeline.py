@@ -0,0 +1,40 @@
+import numpy as np
+import tensorflow as tf
+
+from codemaps import CHANNELS
+
+# Streaming input for model.fit: batches of pairs are encoded by Codemaps as
+# they are needed, in parallel with training steps, instead of encoding the
+# whole data set in memory beforehand.
+
+
+def make_pipeline(codes, data, batch_size=32, shuffle=0, trim=False, seed=None):
+    """
+    create a tf.data.Dataset of (X, Y) batches for all pairs in given data. If
+    shuffle, pairs are shuffled (with a buffer of that many pairs) every epoch.
+    If trim, each batch is padded only to its longest sequence
+    """
+
+    # compute code tables (and data set indexes) once, before worker threads
+    # start encoding batches. Workers get the tables from here, so they only
+    # read them
+    tables = codes.code_tables(data)
+    codes.encode_batch(data, np.arange(0), tables=tables)
+
+    def encode(pairs):
+        X, Y = codes.encode_batch(data, pairs, trim, tables)
+        return (*X, Y)
+
+    def to_tensors(pairs):
+        out = tf.numpy_function(encode, [pairs], [tf.int32] * (len(CHANNELS) + 1))
+        for x in out[:-1]:
+            x.set_shape([None, None if trim else codes.maxlen])
+        out[-1].set_shape([None])
+        return tuple(out[:-1]), out[-1]
+
+    pipeline = tf.data.Dataset.range(len(data.pair_types()))
+    if shuffle:
+        pipeline = pipeline.shuffle(shuffle, seed=seed, reshuffle_each_iteration=True)
+    pipeline = pipeline.batch(batch_size)
+    pipeline = pipeline.map(to_tensors, num_parallel_calls=tf.data.AUTOTUNE)
+    return pipeline.prefetch(tf.data.AUTOTUNE)
@@ -2,6 +2,7 @@
 
 import sys
 import os
+import argparse
 
 from tensorflow.keras.utils import set_random_seed
 from tensorflow.keras.models import Model, load_model
@@ -9,6 +10,9 @@ import numpy as np
 
 from dataset import Dataset
 from codemaps import Codemaps
+from quantize import TFLiteModel
+import prefilter
+import benchmark
 import evaluator
 
 
@@ -41,25 +45,97 @@ def output_interactions(data, preds, outfile):
 
 if __name__ == "__main__":
 
-    if len(sys.argv) != 4:
-        print("Usage:  predict.py <fname> <datafile> <outfile>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Predict DDI with trained model")
+    parser.add_argument("fname")
+    parser.add_argument("datafile")
+    parser.add_argument("outfile")
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="keep encoded data sets in this directory, to reuse them on next runs",
+    )
+    parser.add_argument(
+        "--tflite",
+        action="store_true",
+        help="run the model exported by quantize.py (<fname>.tflite) instead",
+    )
+    parser.add_argument(
+        "--prefilter",
+        metavar="RULES",
+        type=prefilter.parse_rules,
+        default=[],
+        help="output pairs matched by these comma separated rules as null, "
+        "without running the model on them (out of " + ",".join(prefilter.RULES) + ")",
+    )
+    args = parser.parse_args()
 
     set_random_seed(4567998)
     os.environ['PYTHONHASHSEED'] = str(0)
 
-    fname = sys.argv[1]
-    datafile = sys.argv[2]
-    outfile = sys.argv[3]
+    fname = args.fname
+    datafile = args.datafile
+    outfile = args.outfile
 
-    model = load_model(fname)
     codes = Codemaps(fname)
+    if args.cache:
+        codes.set_cache(args.cache)
+
+    if args.tflite and codes.mode == "joint":
+        parser.error("joint models cannot be run with --tflite")
+    if args.tflite:
+        model = TFLiteModel(fname + ".tflite")
+        variable_len = model.variable_len
+        predict = model.predict_on_batch
+    else:
+        model = load_model(fname)
+        variable_len = model.inputs[0].shape[1] is None
+        predict = benchmark.keras_predictor(model)
 
     testdata = Dataset(datafile)
-    X = codes.encode_words(testdata)
-
-    Y = model.predict(X)
-    Y = [codes.idx2label(np.argmax(s)) for s in Y]
+    n_pairs = len(testdata.pair_types())
+
+    # pairs the prefilter rules tell are null need not go through the model
+    skip, counts = prefilter.apply(testdata, args.prefilter)
+    kept = np.flatnonzero(~skip)
+    if args.prefilter:
+        print(
+            f"prefilter: skipped {skip.sum()} of {n_pairs} pairs "
+            f"({skip.sum() / max(n_pairs, 1):.1%}; "
+            + ", ".join(f"{name}: {n}" for name, n in counts.items())
+            + ")",
+            file=sys.stderr,
+        )
+
+    if codes.mode == "joint":
+        # joint model: predict all pairs in batches of similar length sentences
+        batches = [
+            (P[P >= 0], X, P >= 0)
+            for P, X, _ in codes.encode_sentences(testdata, 32, kept)
+        ]
+    elif variable_len:
+        # variable length model: predict batches of similar length sentences
+        batches = [
+            (rows, X, slice(None))
+            for rows, X in codes.encode_buckets(testdata, 32, kept)
+        ]
+    else:
+        X = codes.encode_words(testdata)
+        batches = [
+            (kept[i : i + 32], [x[kept[i : i + 32]] for x in X], slice(None))
+            for i in range(0, len(kept), 32)
+        ]
+
+    # put predictions back in data set order
+    # pairs not run through the model (prefiltered, or that a joint model
+    # cannot classify) are null
+    Y = np.zeros((n_pairs, codes.get_n_labels()))
+    if "null" in codes.label_index:
+        Y[:, codes.label2idx("null")] = 1
+    for rows, X, valid in batches:
+        Y[rows] = predict(X)[valid]
+
+    labels = np.array([codes.idx2label(i) for i in range(codes.get_n_labels())])
+    Y = labels[np.argmax(Y, axis=1)]
 
     # extract relations
     output_interactions(testdata, Y, outfile)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+
+import numpy as np
+
+from dataset import Dataset, FIELDS, ENTITY
+
+# Rules telling, without running any model, that a pair is not a DDI. Pairs
+# they match are output as null directly, instead of being classified.
+
+RULES = {}
+
+
+def rule(name):
+    "register decorated function as the prefilter rule with given name"
+
+    def register(matches):
+        RULES[name] = matches
+        return matches
+
+    return register
+
+
+@rule("same-name")
+def same_name(data):
+    """
+    both entities are the same drug (their tokens have the same lowercase
+    forms). Entities with no token of their own are never matched
+    """
+
+    tokens = data.arrays["tokens"]
+    lc_form = FIELDS.index("lc_form")
+    names = {}
+    for ent, form in zip(tokens[:, ENTITY].tolist(), tokens[:, lc_form].tolist()):
+        if ent >= 0:
+            names.setdefault(ent, []).append(form)
+
+    rows = data.pair_entities()
+    return np.array(
+        [
+            e1 in names and e2 in names and names[e1] == names[e2]
+            for e1, e2 in rows.tolist()
+        ],
+        dtype=bool,
+    )
+
+
+@rule("overlap")
+def overlap(data):
+    "entity spans overlap"
+
+    entities = data.arrays["entities"]
+    rows = data.pair_entities()
+    (s1, e1), (s2, e2) = entities[rows[:, 0], 2:4].T, entities[rows[:, 1], 2:4].T
+    # entities converted from old pickles have no span
+    return (s1 >= 0) & (s2 >= 0) & (s1 <= e2) & (s2 <= e1)
+
+
+@rule("coordination")
+def coordination(data):
+    """
+    entities are coordinated (e.g. in a list of drugs): every token on the
+    dependency path between them, but the one heading the coordination, is a
+    conjunct
+    """
+
+    if "paths" not in data.arrays:
+        raise ValueError("data set has no dependency paths, parse it again")
+
+    strings = data.strings()
+    conj = np.array([s.startswith("conj") for s in strings])
+    rel = data.arrays["tokens"][:, FIELDS.index("rel")]
+    sent_tokens = data.arrays["sent_tokens"]
+    paths, path_offsets = data.arrays["paths"], data.arrays["path_offsets"]
+
+    rows = data.pair_sentences()
+    matches = np.zeros(len(rows), dtype=bool)
+    for p, row in enumerate(rows.tolist()):
+        path = paths[path_offsets[p] : path_offsets[p + 1]]
+        if len(path) >= 2:
+            matches[p] = (~conj[rel[sent_tokens[row] + path]]).sum() <= 1
+    return matches
+
+
+def apply(data, rules):
+    """
+    get which pairs of data are matched by any of the named rules, and how many
+    pairs each rule matches
+    """
+
+    skip = np.zeros(len(data.pair_types()), dtype=bool)
+    counts = {}
+    for name in rules:
+        matches = RULES[name](data)
+        counts[name] = int(matches.sum())
+        skip |= matches
+    return skip, counts
+
+
+def parse_rules(value):
+    "get list of rule names from a comma separated string"
+
+    rules = value.split(",")
+    for name in rules:
+        if name not in RULES:
+            raise argparse.ArgumentTypeError(f"unknown rule: {name}")
+    return rules
+
+
+# --------- MAIN PROGRAM -----------
+# --
+# -- Usage:  prefilter.py devel.ddi [--rules same-name,overlap,coordination]
+# --
+# -- Reports pairs each rule would skip, and the DDIs lost by skipping them
+# --
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Evaluate prefilter rules")
+    parser.add_argument("datafile", help="data set with gold DDI types")
+    parser.add_argument(
+        "--rules",
+        type=parse_rules,
+        default=list(RULES),
+        help="comma separated rules, out of " + ",".join(RULES),
+    )
+    args = parser.parse_args()
+
+    data = Dataset(args.datafile)
+    strings = data.strings()
+    ddi = np.array([strings[t] != "null" for t in data.pair_types().tolist()])
+    n, n_ddi = len(ddi), max(ddi.sum(), 1)
+
+    skip = np.zeros(n, dtype=bool)
+    for name in args.rules:
+        matches = RULES[name](data)
+        skip |= matches
+        print(
+            f"{name}: {matches.sum()} pairs ({matches.sum() / n:.1%}), "
+            f"{(matches & ddi).sum()} DDIs ({(matches & ddi).sum() / n_ddi:.1%} "
+            "recall lost)",
+            file=sys.stderr,
+        )
+
+    print(
+        f"all: {skip.sum()} of {n} pairs skipped ({skip.sum() / n:.1%}), "
+        f"{(skip & ddi).sum()} DDIs ({(skip & ddi).sum() / n_ddi:.1%} recall lost)",
+        file=sys.stderr,
+    )
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import argparse
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import load_model
+
+from dataset import Dataset
+from codemaps import Codemaps
+from networks import INPUTS
+import benchmark
+
+# Trained models exported to TFLite with weights quantized to int8, to make
+# them smaller and faster for inference on CPU.
+
+
+def convert(model, quantize=True, calibration=None):
+    """
+    convert Keras model to a TFLite flatbuffer. If quantize, weights are
+    quantized to int8 and activations kept in float (dynamic range
+    quantization), unless calibration batches (dicts of arrays by input name)
+    are given to quantize activations too (full int8)
+    """
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantize and calibration is not None:
+        converter.representative_dataset = lambda: iter(calibration)
+        # operations without int8 kernels are left in float
+        ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8] + ops
+    converter.target_spec.supported_ops = ops
+
+    return converter.convert()
+
+
+def export(model, filename, calibration=None):
+    "convert Keras model to a quantized TFLite file (see convert)"
+
+    tflite = convert(model, calibration=calibration)
+    with open(filename, "wb") as f:
+        f.write(tflite)
+
+
+class TFLiteModel:
+    "model exported with export(), run by the TFLite interpreter"
+
+    def __init__(self, filename):
+        self.interpreter = tf.lite.Interpreter(
+            model_path=filename, num_threads=os.cpu_count()
+        )
+        runner = self.interpreter.get_signature_runner()
+        inputs = runner.get_input_details()
+        self.inputs = [inputs[name] for name in INPUTS]
+        self.output = next(iter(runner.get_output_details().values()))["index"]
+        self.variable_len = self.inputs[0]["shape_signature"][1] == -1
+        self.shape = None
+
+    def predict_on_batch(self, X):
+        "get label probabilities for a batch of encoded sequences"
+
+        # tensors are only reallocated when batch shape changes
+        if X[0].shape != self.shape:
+            for i in self.inputs:
+                self.interpreter.resize_tensor_input(i["index"], X[0].shape)
+            self.interpreter.allocate_tensors()
+            self.shape = X[0].shape
+
+        for i, x in zip(self.inputs, X):
+            self.interpreter.set_tensor(i["index"], x.astype(i["dtype"]))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output)
+
+
+# --------- MAIN PROGRAM -----------
+# --
+# -- Usage:  quantize.py [--int8] model devel.ddi
+# --
+# -- Writes model.tflite, and compares it with the float model on devel.ddi
+# --
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Export quantized TFLite model")
+    parser.add_argument("fname", help="trained model (also gets the .tflite)")
+    parser.add_argument("datafile", help="data set to calibrate and compare with")
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="quantize activations too (full int8), instead of only weights",
+    )
+    parser.add_argument(
+        "--calibration",
+        type=int,
+        default=200,
+        help="pairs sampled from datafile to calibrate int8 activations with",
+    )
+    args = parser.parse_args()
+
+    model = load_model(args.fname)
+    codes = Codemaps(args.fname)
+    if codes.mode == "joint":
+        parser.error("joint models cannot be exported yet")
+    data = Dataset(args.datafile)
+    variable_len = model.inputs[0].shape[1] is None
+
+    calibration = None
+    if args.int8:
+        n = len(data.pair_types())
+        rng = np.random.default_rng(4567998)
+        pairs = rng.choice(n, min(args.calibration, n), replace=False)
+        calibration = []
+        for p in pairs:
+            # padded to maxlen, so all calibration inputs have the same shape
+            X, _ = codes.encode_batch(data, [p])
+            calibration.append(
+                {
+                    name: x.astype(i.dtype.as_numpy_dtype)
+                    for name, x, i in zip(INPUTS, X, model.inputs)
+                }
+            )
+
+    filename = args.fname + ".tflite"
+    export(model, filename, calibration)
+
+    # compare with the float model, sized as a TFLite file too (its SavedModel
+    # directory also holds optimizer state and graph definitions)
+    lite = TFLiteModel(filename)
+    results = [
+        (
+            args.fname,
+            len(convert(model, quantize=False)),
+            benchmark.keras_predictor(model),
+        ),
+        (filename, os.path.getsize(filename), lite.predict_on_batch),
+    ]
+    stats = []
+    for name, size, predict in results:
+        stats.append(
+            benchmark.evaluate_predictor(predict, codes, data, trim=variable_len)
+        )
+        print(
+            f"{name}: {size / 2**20:.1f} MB, {stats[-1]['latency_ms']:.1f} ms/batch, "
+            f"F1 {stats[-1]['f1']:.4f}",
+            file=sys.stderr,
+        )
+
+    print(
+        f"quantized: {results[0][1] / results[1][1]:.1f}x smaller, "
+        f"{stats[0]['latency_ms'] / stats[1]['latency_ms']:.1f}x faster, "
+        f"F1 {stats[1]['f1'] - stats[0]['f1']:+.4f}",
+        file=sys.stderr,
+    )
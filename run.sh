@@ -4,6 +4,14 @@ BASEDIR=../resources/DDI
 
 UTIL=./util/
 
+# concurrent requests to (and threads of) the CoreNLP server when parsing
+PARSE_THREADS="${PARSE_THREADS:-4}"
+# parses are cached here, so unchanged sentences are not sent to the server again
+PARSE_CACHE="${PARSE_CACHE:-parse.cache}"
+# encoded data sets are cached here, so they are only encoded again if the data
+# or the codemaps change
+ENCODE_CACHE="${ENCODE_CACHE:-encoded.cache}"
+
 export PYTHONPATH="$UTIL" #Directory of the DDI data
 
 set -e # Abort if something fails
@@ -14,33 +22,38 @@ if [[ "$#" == "0" ]]; then
 fi
 
 if [[ "$*" == *"parse"* ]]; then
-   "$UTIL"/corenlp-server.sh -quiet true -port 9000 -timeout 15000 &
+   "$UTIL"/corenlp-server.sh -quiet true -port 9000 -timeout 15000 -threads "$PARSE_THREADS" &
    sleep 1
 
-   python3 parse_data.py "$BASEDIR"/data/train train.pck
-   python3 parse_data.py "$BASEDIR"/data/devel devel.pck
-   python3 parse_data.py "$BASEDIR"/data/test test.pck
+   python3 parse_data.py --batch --threads "$PARSE_THREADS" --cache "$PARSE_CACHE" "$BASEDIR"/data/train train.ddi
+   python3 parse_data.py --batch --threads "$PARSE_THREADS" --cache "$PARSE_CACHE" "$BASEDIR"/data/devel devel.ddi
+   python3 parse_data.py --batch --threads "$PARSE_THREADS" --cache "$PARSE_CACHE" "$BASEDIR"/data/test test.ddi
    kill "$(cat /tmp/corenlp-server.running)"
 fi
 
 if [[ "$*" == *"train"* ]]; then
     rm -rf model*
-    python3 train.py train.pck devel.pck model
+    python3 train.py --cache "$ENCODE_CACHE" train.ddi devel.ddi model
 fi
 
 if [[ "$*" == *"plot"* ]]; then
     python3 plot_model.py model
 fi
 
+if [[ "$*" == *"quantize"* ]]; then
+    # export model.tflite (QUANTIZE=--int8 for full int8), compared on devel
+    python3 quantize.py $QUANTIZE model devel.ddi
+fi
+
 if [[ "$*" == *"predict"* ]]; then
    rm -f devel.stats devel.out
-   python3 predict.py model devel.pck devel.out
+   python3 predict.py --cache "$ENCODE_CACHE" model devel.ddi devel.out
    python3 "$UTIL"/evaluator.py DDI "$BASEDIR"/data/devel devel.out | tee devel.stats
 fi
 
 if [[ "$*" == *"test"* ]]; then
    rm -f test.stats test.out
-   python3 predict.py model test.pck test.out
+   python3 predict.py --cache "$ENCODE_CACHE" model test.ddi test.out
    python3 "$UTIL"/evaluator.py DDI "$BASEDIR"/data/test test.out | tee test.stats
 
    UNCOMMITED=false
@@ -4,91 +4,151 @@
 import sys
 import os
 import random
+import argparse
 from contextlib import redirect_stdout
 
 import matplotlib.pyplot as plt
 
 import tensorflow as tf
 from tensorflow.keras.utils import set_random_seed
-from tensorflow.keras import regularizers, Input
-from tensorflow.keras.models import Model
-from tensorflow.keras.layers import (
-    Embedding,
-    Dense,
-    Dropout,
-    Conv1D,
-    MaxPool1D,
-    Reshape,
-    Concatenate,
-    Add,
-    Flatten,
-    Bidirectional,
-    LSTM,
-)
+from tensorflow.keras import Input
+from tensorflow.keras.models import Model, load_model
+from tensorflow.keras.layers import Embedding, Dense, Dropout, Concatenate
 
 import numpy as np
 
-from dataset import Dataset
-from codemaps import Codemaps
-from transformer import TokenAndPositionEmbedding, TransformerBlock
-
-
-def load_glove_embedding(word2index: dict, embedding_dim: int = 100) -> Embedding:
-    glove_path = f"../glove.6B/glove.6B.{embedding_dim}d.txt"
-
-    n_words = len(word2index)
-    embedding_matrix = np.zeros((n_words, embedding_dim))
-
-    with open(glove_path, "r") as f:
-        for _line in f:
-            line = _line.split()
-            word = line[0]
-            if word in word2index:
-                idx = word2index[word]
-                embedding_vector = np.array(line[1:], dtype=np.float32)
-                embedding_matrix[idx] = embedding_vector
+import glove
+from dataset import Dataset, MASKS
+from codemaps import Codemaps, MODES
+from pipeline import make_pipeline
+from heads import HEADS, PairPooling, build_head
+from networks import ARCHITECTURES, INPUTS
+import benchmark
+from transformer import TokenAndPositionEmbedding
+
+
+def load_glove_embeddings(indexes, embedding_dim: int = 100) -> list:
+    """
+    get a frozen GloVe Embedding for each of given (key to code index, number of
+    codes) pairs, converting the GloVe text file first if not done yet
+    """
+
+    glove_path = f"../glove.6B/glove.6B.{embedding_dim}d"
+    if not os.path.isdir(glove_path + ".glove"):
+        print(f"converting {glove_path}.txt", file=sys.stderr)
+        glove.convert(glove_path + ".txt", glove_path + ".glove")
+
+    return [
+        Embedding(len(matrix), embedding_dim, weights=[matrix], trainable=False)
+        for matrix in glove.embedding_matrices(glove_path + ".glove", indexes)
+    ]
 
-    return Embedding(
-        n_words, embedding_dim, weights=[embedding_matrix], trainable=False
-    )
 
+def build_network(
+    codes,
+    variable_len=False,
+    head=None,
+    arch="bilstm",
+    channels=None,
+    glove=True,
+    embedding_dim=100,
+):
+    """
+    build network for given codemaps. If variable_len, it takes sequences of any
+    length up to maxlen, ignoring padding, instead of exactly maxlen. Token
+    states are computed by one of ARCHITECTURES and summarized by one of HEADS
+    (by default, flatten for fixed length sequences and mean for variable
+    length ones). The network takes all INPUTS, but only embeds those in
+    channels (all by default), adding GloVe embeddings of words if glove.
+    With joint codemaps, it takes whole sentences and the entity positions of
+    their pairs (input_pairs), and classifies each pair from the states of its
+    entities instead
+    """
+
+    head = head or ("mean" if variable_len else "flatten")
+    if variable_len and head == "flatten":
+        raise ValueError("flatten head needs fixed length sequences")
+    if codes.mode == "joint" and not variable_len:
+        raise ValueError("joint models need variable length sequences")
 
-def build_network(codes):
     n_labels = codes.get_n_labels()
     max_len = codes.maxlen
-    embedding_dim = 100
-
-    input_val = [
-        ("w", codes.get_n_words()),
-        ("lw", codes.get_n_lc_words()),
-        ("rel", codes.get_n_rel()),
-        ("l", codes.get_n_lemmas()),
-        ("p", codes.get_n_pos()),
-    ]
+    channels = channels or INPUTS
+
+    input_val = zip(
+        INPUTS,
+        [
+            codes.get_n_words(),
+            codes.get_n_lc_words(),
+            codes.get_n_rel(),
+            codes.get_n_lemmas(),
+            codes.get_n_pos(),
+        ],
+    )
 
     input_names, input_vocab_sz = zip(*input_val)
-    inputs = list(map(lambda x: Input(shape=(max_len,), name=f"input_{x}"), input_names))
+    shape = (None,) if variable_len else (max_len,)
+    inputs = list(map(lambda x: Input(shape=shape, name=x, dtype="int32"), input_names))
 
-    embeddings = list(
-        map(lambda input, vocab_size: TokenAndPositionEmbedding(
+    embeddings = [
+        TokenAndPositionEmbedding(
             maxlen=max_len, vocab_size=vocab_size, embed_dim=embedding_dim
-        )(input), inputs, input_vocab_sz)
-    ) + [
-        load_glove_embedding(codes.word_index, embedding_dim=embedding_dim)(inputs[0]),
-        load_glove_embedding(codes.lc_word_index, embedding_dim=embedding_dim)(inputs[1]),
+        )(input)
+        for name, input, vocab_size in zip(input_names, inputs, input_vocab_sz)
+        if name in channels
     ]
+
+    if glove:
+        # pretrained vectors for the word and lowercase word inputs
+        words = [
+            (inputs[0], codes.word_index, codes.get_n_words()),
+            (inputs[1], codes.lc_word_index, codes.get_n_lc_words()),
+        ]
+        words = [w for name, w in zip(input_names, words) if name in channels]
+        if words:
+            glove_embeddings = load_glove_embeddings(
+                [(index, n_words) for _, index, n_words in words],
+                embedding_dim=embedding_dim,
+            )
+            for embedding, (input, _, _) in zip(glove_embeddings, words):
+                embeddings.append(embedding(input))
+
     embeddings = list(map(Dropout(0.2), embeddings))
 
-    concatenated = Concatenate()(embeddings)
-    lstm = Bidirectional(LSTM(units=128, return_sequences=True))(concatenated)
-    flat = Flatten()(lstm)
+    concatenated = Concatenate()(embeddings) if len(embeddings) > 1 else embeddings[0]
+    # pool over actual tokens only, padding may be any length
+    mask = None
+    if head != "flatten":
+        mask = tf.not_equal(inputs[0], codes.word_index["PAD"])
+    states = ARCHITECTURES[arch](concatenated, mask)
+
+    if codes.mode == "joint":
+        # all pairs of a sentence are classified from the same states
+        pairs = Input(shape=(None, 2), name="input_pairs", dtype="int32")
+        inputs.append(pairs)
+        flat = PairPooling()(states, pairs)
+    else:
+        markers = [codes.word_index[MASKS[e][0]] for e in ("e1", "e2")]
+        flat = build_head(head, states, mask, words=inputs[0], markers=markers)
 
     dense = Dense(n_labels * 4, activation="relu")(flat)
     dense = Dropout(0.2)(dense)
     out = Dense(n_labels, activation="softmax")(dense)
 
     model = Model(inputs, out)
-    model.compile(loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
+    if codes.mode == "joint":
+        # padding pairs are given no weight
+        model.compile(
+            loss="sparse_categorical_crossentropy",
+            optimizer="adam",
+            weighted_metrics=["accuracy"],
+        )
+    else:
+        model.compile(
+            loss="sparse_categorical_crossentropy",
+            optimizer="adam",
+            metrics=["accuracy"],
+        )
     return model
 
 
@@ -103,6 +163,42 @@ def build_network(codes):
 # --
 
 
+def soft_labels(teacher, codes, data, temperature=1.0, batch_size=32):
+    "get label probabilities teacher gives to each pair in data, softened"
+
+    predict = benchmark.keras_predictor(teacher)
+    trim = teacher.inputs[0].shape[1] is None
+    n = len(data.pair_types())
+    Y = np.zeros((n, codes.get_n_labels()), dtype=np.float32)
+    for start in range(0, n, batch_size):
+        pairs = np.arange(start, min(start + batch_size, n))
+        X, _ = codes.encode_batch(data, pairs, trim)
+        Y[pairs] = predict(X)
+
+    # same as a softmax of the teacher logits divided by temperature
+    Y = Y ** (1 / temperature)
+    return Y / Y.sum(axis=1, keepdims=True)
+
+
+class BucketSequence(tf.keras.utils.Sequence):
+    "given batches of different shapes, in a different order every epoch"
+
+    def __init__(self, batches):
+        super().__init__()
+        self.batches = batches
+        self.order = np.arange(len(self.batches))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, i):
+        return self.batches[self.order[i]]
+
+    def on_epoch_end(self):
+        np.random.shuffle(self.order)
+
+
 def set_memory_growth():
     gpus = tf.config.list_physical_devices("GPU")
     if gpus:
@@ -121,42 +217,241 @@ if __name__ == "__main__":
 
     set_memory_growth()
 
-    if len(sys.argv) != 4:
-        print("Usage: train.py <trainfile> <validationfile>  <modelname>")
-        exit(1)
+    parser = argparse.ArgumentParser(description="Train DDI classifier")
+    parser.add_argument("trainfile")
+    parser.add_argument("validationfile")
+    parser.add_argument("modelname")
+    parser.add_argument(
+        "--bucket",
+        action="store_true",
+        help="train on batches of similar length sentences, padded only to the "
+        "longest one in each batch, instead of padding all of them to max length",
+    )
+    parser.add_argument(
+        "--min-freq",
+        type=int,
+        default=1,
+        help="leave keys seen less than this many times in training out of indexes",
+    )
+    parser.add_argument(
+        "--hash-buckets",
+        type=int,
+        default=0,
+        help="code keys left out of an index by hashing them into this many "
+        "buckets, instead of as unknown",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="keep encoded data sets in this directory, to reuse them on next runs",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="encode batches while training, instead of whole data sets before it",
+    )
+    parser.add_argument(
+        "--shuffle-buffer",
+        type=int,
+        default=10000,
+        help="pairs to shuffle training data with, when streaming it",
+    )
+    parser.add_argument(
+        "--head",
+        choices=HEADS,
+        help="how BiLSTM states are summarized for classification (default: "
+        "flatten, or mean with --bucket)",
+    )
+    parser.add_argument(
+        "--arch",
+        choices=sorted(ARCHITECTURES),
+        default="bilstm",
+        help="network computing token states from their embeddings",
+    )
+    parser.add_argument(
+        "--results",
+        default="benchmarks.csv",
+        metavar="FILE",
+        help="CSV file to append the size, speed and F1 of the trained model to",
+    )
+    parser.add_argument(
+        "--channels",
+        type=lambda s: [f"input_{c}" for c in s.split(",")],
+        help="comma separated inputs to embed, out of "
+        + ",".join(name[len("input_") :] for name in INPUTS)
+        + " (default: all)",
+    )
+    parser.add_argument(
+        "--no-glove",
+        action="store_true",
+        help="do not add pretrained GloVe embeddings of words",
+    )
+    parser.add_argument(
+        "--embedding-dim",
+        type=int,
+        default=100,
+        help="size of token embeddings (GloVe ones need one of 50, 100, 200, 300)",
+    )
+    parser.add_argument(
+        "--distill",
+        metavar="TEACHER",
+        help="train model to reproduce the predictions of given trained model, "
+        "using its codemaps",
+    )
+    parser.add_argument(
+        "--temperature",
+        type=float,
+        default=2.0,
+        help="softening of teacher probabilities when distilling",
+    )
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=0.9,
+        help="weight of teacher probabilities against gold labels when distilling",
+    )
+    parser.add_argument(
+        "--input",
+        choices=MODES,
+        default="sentence",
+        help="encode each pair as its sentence, or as the shortest dependency "
+        "path between its entities (plus --window tokens around it), or (joint) "
+        "each sentence once, classifying all its pairs in the same pass",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=2,
+        help="tokens of context before and after the dependency path, with sdp",
+    )
+    parser.add_argument(
+        "--maxlen",
+        type=int,
+        help="tokens of each encoded sequence, longer ones keep their end "
+        "(default: 150, or 32 with sdp)",
+    )
+    args = parser.parse_args()
+    if args.distill and args.stream:
+        parser.error("--distill needs teacher labels for whole data sets, not --stream")
+    if args.input == "joint" and (args.stream or args.distill or args.head):
+        parser.error("--input joint works without --stream, --distill or --head")
+    if args.bucket and args.head == "flatten":
+        parser.error("--head flatten needs fixed length sequences, not --bucket")
+    unknown = [c[len("input_") :] for c in args.channels or [] if c not in INPUTS]
+    if unknown:
+        parser.error("unknown --channels: " + ",".join(unknown))
 
     set_random_seed(2795991)
     os.environ["PYTHONHASHSEED"] = str(0)
 
     # directory with files to process
-    trainfile = sys.argv[1]
-    validationfile = sys.argv[2]
-    modelname = sys.argv[3]
+    trainfile = args.trainfile
+    validationfile = args.validationfile
+    modelname = args.modelname
 
     # load train and validation data
     traindata = Dataset(trainfile)
     valdata = Dataset(validationfile)
 
-    # create indexes from training data
-    max_len = 150
+    # create indexes from training data, or take those of the teacher
+    max_len = args.maxlen or (32 if args.input == "sdp" else 150)
     suf_len = 5
-    codes = Codemaps(traindata, max_len)
-
-    # build network
-    model = build_network(codes)
+    if args.distill:
+        teacher = load_model(args.distill)
+        codes = Codemaps(args.distill)
+        if codes.mode == "joint":
+            parser.error("--distill does not support joint teachers")
+    else:
+        codes = Codemaps(
+            traindata,
+            max_len,
+            args.min_freq,
+            args.hash_buckets,
+            mode=args.input,
+            window=args.window,
+        )
+    if args.cache:
+        codes.set_cache(args.cache)
+
+    # build network (joint models always take sentences of any length)
+    bucket = args.bucket or codes.mode == "joint"
+    if codes.mode == "joint":
+        head = "pair"
+    else:
+        head = args.head or ("mean" if bucket else "flatten")
+    model = build_network(
+        codes,
+        variable_len=bucket,
+        head=head,
+        arch=args.arch,
+        channels=args.channels,
+        glove=not args.no_glove,
+        embedding_dim=args.embedding_dim,
+    )
+    if args.distill:
+        # targets are label probabilities instead of label codes
+        model.compile(
+            loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"]
+        )
     with redirect_stdout(sys.stderr):
         model.summary()
 
     # encode datasets
-    Xt = codes.encode_words(traindata)
-    Yt = codes.encode_labels(traindata)
-    Xv = codes.encode_words(valdata)
-    Yv = codes.encode_labels(valdata)
+    batch_size = 32
+    if args.stream:
+        train = dict(
+            x=make_pipeline(
+                codes, traindata, batch_size, args.shuffle_buffer, args.bucket
+            )
+        )
+        val = make_pipeline(codes, valdata, batch_size, trim=args.bucket)
+    elif codes.mode == "joint":
+        # batches of sentences, with all their pairs (padding ones weigh 0)
+        train, val = [
+            BucketSequence(
+                [
+                    (X, Y, (P >= 0).astype(np.float32))
+                    for P, X, Y in codes.encode_sentences(data, batch_size)
+                ]
+            )
+            for data in (traindata, valdata)
+        ]
+        train = dict(x=train)
+    else:
+        Yt = codes.encode_labels(traindata)
+        Yv = codes.encode_labels(valdata)
+        if args.distill:
+            # teacher probabilities, mixed with gold labels
+            onehot = np.eye(codes.get_n_labels(), dtype=np.float32)
+            soft = soft_labels(teacher, codes, traindata, args.temperature, batch_size)
+            Yt = args.alpha * soft + (1 - args.alpha) * onehot[Yt]
+            Yv = onehot[Yv]
+
+        if args.bucket:
+            train = dict(
+                x=BucketSequence(
+                    [
+                        (X, Yt[rows])
+                        for rows, X in codes.encode_buckets(traindata, batch_size)
+                    ]
+                )
+            )
+            val = BucketSequence(
+                [(X, Yv[rows]) for rows, X in codes.encode_buckets(valdata, batch_size)]
+            )
+        else:
+            train = dict(x=codes.encode_words(traindata), y=Yt, batch_size=batch_size)
+            val = (codes.encode_words(valdata), Yv)
 
     # train model
+    throughput = benchmark.Throughput(len(traindata.pair_types()))
     with redirect_stdout(sys.stderr):
         history = model.fit(
-            Xt, Yt, batch_size=32, epochs=10, validation_data=(Xv, Yv), verbose=1
+            **train,
+            epochs=10,
+            validation_data=val,
+            verbose=1,
+            callbacks=[throughput],
         )
 
     if not os.path.exists("plots"):
@@ -179,6 +474,45 @@ if __name__ == "__main__":
     plt.legend(["train", "test"], loc="upper left")
     plt.savefig("plots/epoch-loss.pdf", bbox_inches="tight")
 
+    # report size, speed and quality, to compare with other models
+    stats = benchmark.evaluate(model, codes, valdata, batch_size, trim=bucket)
+    stats["train_samples_s"] = throughput.samples_per_second()
+    print(
+        f"model: {args.arch} with {head} head, "
+        f"{stats['params']} parameters, {stats['train_samples_s']:.0f} samples/s "
+        f"training, {stats['latency_ms']:.1f} ms/batch, "
+        f"F1 {stats['f1']:.4f} on {validationfile}",
+        file=sys.stderr,
+    )
+    if args.distill:
+        teacher_stats = benchmark.evaluate(
+            teacher,
+            codes,
+            valdata,
+            batch_size,
+            trim=teacher.inputs[0].shape[1] is None,
+        )
+        print(
+            f"distilled: F1 {stats['f1'] / max(teacher_stats['f1'], 1e-9):.2f}x "
+            f"the teacher's, {teacher_stats['latency_ms'] / stats['latency_ms']:.1f}x "
+            f"faster, {teacher_stats['params'] / stats['params']:.1f}x fewer "
+            "parameters",
+            file=sys.stderr,
+        )
+
+    benchmark.append_results(
+        args.results,
+        dict(
+            model=modelname,
+            arch=args.arch,
+            head=head,
+            bucket=bucket,
+            data=validationfile,
+            **stats,
+            teacher=args.distill or "",
+        ),
+    )
+
     # save model and indexs
     model.save(modelname)
     codes.save(modelname)
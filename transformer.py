@@ -18,8 +18,10 @@ class TransformerBlock(layers.Layer):
         self.dropout1 = layers.Dropout(rate)
         self.dropout2 = layers.Dropout(rate)
 
-    def call(self, inputs, training):
-        attn_output = self.att(inputs, inputs)
+    def call(self, inputs, training, mask=None):
+        # padding positions (where mask is false) are not attended to
+        attention_mask = None if mask is None else mask[:, tf.newaxis, :]
+        attn_output = self.att(inputs, inputs, attention_mask=attention_mask)
         attn_output = self.dropout1(attn_output, training=training)
         out1 = self.layernorm1(inputs + attn_output)
         ffn_output = self.ffn(out1)
@@ -8,23 +8,13 @@
 # usage:  ./ddi2gold.py data-directory
 
 import sys
-from os import listdir
-from xml.dom.minidom import parse
+from ddixml import read_dir
 
 # directory with files to process
 datadir = sys.argv[1]
 
-# process each file in directory
-for f in listdir(datadir):
-
-    tree = parse(datadir + "/" + f)
-
-    pairs = tree.getElementsByTagName("pair")
-    for p in pairs:
-        if p.attributes["ddi"].value == "true":
-            print(
-                p.attributes["e1"].value,
-                p.attributes["e2"].value,
-                p.attributes["type"].value,
-                sep="|",
-            )
+# process each sentence in the directory
+for s in read_dir(datadir):
+    for p in s["pairs"]:
+        if p["ddi"] == "true":
+            print(p["e1"], p["e2"], p["type"], sep="|")
@@ -0,0 +1,38 @@
+from os import listdir
+from xml.etree.ElementTree import iterparse
+
+# Streaming reader for DDI corpus XML files. Sentences are yielded as plain
+# dicts as soon as they are parsed, and their elements dropped right after,
+# so memory does not grow with the size of the file.
+
+
+# --------------------------------------------------------------
+# iterate over sentences in a DDI XML file
+def read_file(filename):
+    """
+    iterate over sentences in a DDI XML file. Each sentence is a dict with its
+    "id" and "text", and lists of "entities" and "pairs" (dicts of their attributes)
+    """
+
+    context = iterparse(filename, events=("start", "end"))
+    _, root = next(context)  # <document> element
+
+    for event, elem in context:
+        if event == "end" and elem.tag == "sentence":
+            yield {
+                "id": elem.get("id"),
+                "text": elem.get("text"),
+                "entities": [dict(e.attrib) for e in elem.iter("entity")],
+                "pairs": [dict(p.attrib) for p in elem.iter("pair")],
+            }
+            # forget already processed sentences
+            root.clear()
+
+
+# --------------------------------------------------------------
+# iterate over sentences in all DDI XML files in a directory
+def read_dir(dirname):
+    "iterate over sentences in all DDI XML files in a directory"
+
+    for f in listdir(dirname):
+        yield from read_file(dirname + "/" + f)
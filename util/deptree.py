@@ -1,51 +1,496 @@
 import sys
 import os
-
+import time
+import json
+import zlib
+import sqlite3
+import hashlib
+import threading
+from bisect import bisect_right
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
 from nltk.parse.corenlp import CoreNLPDependencyParser
 
 dep_parser = CoreNLPDependencyParser(url="http://localhost:9000")
 
+# properties sent along with each request: only the annotators we need, and
+# one sentence per line
+PARSE_PROPERTIES = {
+    "annotators": "tokenize,ssplit,pos,lemma,depparse",
+    "ssplit.eolonly": "true",
+    "tokenize.whitespace": "false",
+}
+
+# characters split from their neighbours before parsing
+SPLIT = {"/": " / ", "-": " - ", ".": ". ", "'": " ' "}
+
+# number of requests in flight, per request timeout (seconds) and retries, and
+# whether all sentences in a document are sent in one request. see set_pool
+THREADS = 1
+TIMEOUT = 60
+RETRIES = 3
+BATCH = False
+
+# persistent cache of parsed sentences, see set_cache
+CACHE = None
+
 DEBUG = os.environ.get("DEBUG", False)
 
 
+class ParseCache:
+    """
+    Disk-backed (SQLite) cache of CoreNLP parses, keyed by a hash of the
+    normalized sentence text and the parser settings. Least recently used
+    entries are evicted when it holds more than max_entries sentences.
+    Changes are written right away (in WAL mode), so several processes can
+    share the same cache file.
+    """
+
+    def __init__(self, filename, max_entries=1000000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(
+            filename, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS parses "
+            "(key TEXT PRIMARY KEY, parse BLOB NOT NULL, used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS parses_used ON parses (used)")
+        (self.size,) = self.db.execute("SELECT COUNT(*) FROM parses").fetchone()
+
+        # anything changing the parser output must be part of the key
+        self.settings = json.dumps(
+            [dep_parser.parser_annotator, PARSE_PROPERTIES], sort_keys=True
+        )
+
+    def key(self, txt):
+        "get cache key for given (normalized) sentence"
+
+        return hashlib.sha256((self.settings + "\n" + txt).encode("utf8")).hexdigest()
+
+    def get(self, txt):
+        "get cached parse for given sentence, or None if not there"
+
+        key = self.key(txt)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT parse FROM parses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.db.execute(
+                "UPDATE parses SET used = ? WHERE key = ?", (time.time(), key)
+            )
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, txt, parse):
+        "store parse for given sentence, evicting least recently used ones if full"
+
+        blob = zlib.compress(json.dumps(parse).encode("utf8"))
+        with self.lock:
+            cur = self.db.execute(
+                "INSERT OR IGNORE INTO parses VALUES (?, ?, ?)",
+                (self.key(txt), blob, time.time()),
+            )
+            self.size += cur.rowcount
+            if self.size > self.max_entries:
+                # other processes may have added (or evicted) entries too
+                (self.size,) = self.db.execute("SELECT COUNT(*) FROM parses").fetchone()
+                n = max(0, self.size - self.max_entries)
+                self.db.execute(
+                    "DELETE FROM parses WHERE key IN "
+                    "(SELECT key FROM parses ORDER BY used LIMIT ?)",
+                    (n,),
+                )
+                self.size -= n
+                self.evicted += n
+
+    def close(self):
+        "close the cache file"
+
+        with self.lock:
+            self.db.close()
+
+    def take_counts(self):
+        "get hits, misses and evictions counted so far, and restart counting"
+
+        with self.lock:
+            counts = (self.hits, self.misses, self.evicted)
+            self.hits = self.misses = self.evicted = 0
+        return counts
+
+    def add_counts(self, counts):
+        "add hits, misses and evictions counted elsewhere (e.g. in another process)"
+
+        with self.lock:
+            self.hits += counts[0]
+            self.misses += counts[1]
+            self.evicted += counts[2]
+
+    def stats(self):
+        "get a readable summary of cache usage"
+
+        with self.lock:
+            (self.size,) = self.db.execute("SELECT COUNT(*) FROM parses").fetchone()
+        total = self.hits + self.misses
+        return "parse cache: {} hits, {} misses ({:.1%} hit rate), {} evicted, {} entries".format(
+            self.hits,
+            self.misses,
+            self.hits / total if total else 0,
+            self.evicted,
+            self.size,
+        )
+
+
+# --------------------------------------------------------------
+# use a persistent cache of parsed sentences (None to disable it)
+def set_cache(filename, max_entries=1000000):
+    "use a persistent cache of parsed sentences (None to disable it)"
+
+    global CACHE
+    if CACHE is not None:
+        CACHE.close()
+    CACHE = ParseCache(filename, max_entries) if filename is not None else None
+    return CACHE
+
+
+# --------------------------------------------------------------
+# get a description of everything that changes the trees we build
+def parser_settings():
+    "get a description of everything that changes the trees we build"
+
+    return json.dumps(
+        [dep_parser.parser_annotator, PARSE_PROPERTIES, SPLIT], sort_keys=True
+    )
+
+
+# --------------------------------------------------------------
+# get the cache in use, if any
+def get_cache():
+    "get the cache in use, if any"
+
+    return CACHE
+
+
+# --------------------------------------------------------------
+# get pool and cache configuration, to set up other processes alike
+def get_config():
+    "get pool and cache configuration, to set up other processes alike"
+
+    return {
+        "threads": THREADS,
+        "timeout": TIMEOUT,
+        "retries": RETRIES,
+        "batch": BATCH,
+        "cache": CACHE.filename if CACHE is not None else None,
+        "cache_size": CACHE.max_entries if CACHE is not None else None,
+    }
+
+
+# --------------------------------------------------------------
+# apply a configuration obtained with get_config
+def set_config(config):
+    "apply a configuration obtained with get_config"
+
+    set_pool(config["threads"], config["timeout"], config["retries"], config["batch"])
+    if config["cache"] is not None:
+        set_cache(config["cache"], config["cache_size"])
+
+
+# --------------------------------------------------------------
+# configure requests to the CoreNLP server
+def set_pool(threads=1, timeout=60, retries=3, batch=False):
+    "configure requests to the CoreNLP server"
+
+    global THREADS, TIMEOUT, RETRIES, BATCH
+    THREADS, TIMEOUT, RETRIES, BATCH = max(1, threads), timeout, retries, batch
+
+    # keep-alive connections, one per thread, instead of requests' default of 10
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=THREADS)
+    dep_parser.session.mount("http://", adapter)
+    dep_parser.session.mount("https://", adapter)
+
+
+# --------------------------------------------------------------
+# split tokens CoreNLP tends to glue together, keeping track of where each
+# character of the resulting text comes from
+def normalize(txt):
+    """
+    split tokens CoreNLP tends to glue together. Returns the new text, and the
+    position in txt of each of its characters
+    """
+
+    txt2 = []
+    positions = []
+    for i, c in enumerate(txt):
+        # a line break would make the server split the sentence
+        c = SPLIT.get(c, " " if c in "\r\n" else c)
+        txt2.append(c)
+        positions.extend([i] * len(c))
+    return "".join(txt2), positions
+
+
+# --------------------------------------------------------------
+# send a text to the server, retrying failed requests, and get its sentences
+def request(txt):
+    "send a text to the server, retrying failed requests, and get its sentences"
+
+    for attempt in range(RETRIES + 1):
+        try:
+            parsed = dep_parser.api_call(
+                txt, properties=PARSE_PROPERTIES, timeout=TIMEOUT
+            )
+            return parsed["sentences"]
+        except RequestException as e:
+            if attempt == RETRIES:
+                raise
+            print("deptree: request failed (" + str(e) + "), retrying", file=sys.stderr)
+            time.sleep(2**attempt)
+
+
+# --------------------------------------------------------------
+# send a (normalized) sentence to the server (or get it from the cache)
+def parse_sentence(txt):
+    "send a (normalized) sentence to the server, and get its parse"
+
+    if CACHE is not None:
+        sentence = CACHE.get(txt)
+        if sentence is not None:
+            return sentence
+
+    (sentence,) = request(txt)
+    if CACHE is not None:
+        CACHE.put(txt, sentence)
+    return sentence
+
+
+# --------------------------------------------------------------
+# analyze all sentences of a document with a single request
+def parse_document(txts):
+    "analyze all sentences of a document with a single request"
+
+    normalized = [normalize(txt) for txt in txts]
+    parses = [None] * len(txts)
+    if CACHE is not None:
+        parses = [CACHE.get(txt2) for txt2, _ in normalized]
+
+    # send sentences not in the cache, one per line
+    missing = [i for i, p in enumerate(parses) if p is None and txts[i] != ""]
+    if missing:
+        sentences = request("\n".join(normalized[i][0] for i in missing))
+
+        if len(sentences) != len(missing):
+            # the server did not split the text as expected, go one by one
+            print(
+                "deptree: unexpected sentence split, parsing one by one",
+                file=sys.stderr,
+            )
+            sentences = [parse_sentence(normalized[i][0]) for i in missing]
+        else:
+            # make character offsets relative to each sentence
+            base = 0
+            for i, sentence in zip(missing, sentences):
+                for token in sentence["tokens"]:
+                    token["characterOffsetBegin"] -= base
+                    token["characterOffsetEnd"] -= base
+                base += len(normalized[i][0]) + 1
+                if CACHE is not None:
+                    CACHE.put(normalized[i][0], sentence)
+
+        for i, sentence in zip(missing, sentences):
+            parses[i] = sentence
+
+    return [deptree(txt, parse) for txt, parse in zip(txts, parses)]
+
+
+# --------------------------------------------------------------
+# run f on each of given items, keeping THREADS of them in flight
+def _map(f, items):
+    "run f on each of given items, keeping THREADS of them in flight"
+
+    if THREADS == 1:
+        return [f(x) for x in items]
+
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        return list(pool.map(f, items))
+
+
+# --------------------------------------------------------------
+# analyze a list of documents (each a list of sentences)
+def parse_all(docs):
+    """
+    analyze a list of documents (each a list of sentences), returning their
+    trees in the same order. In batch mode, one request is sent per document
+    """
+
+    if BATCH:
+        return _map(parse_document, docs)
+
+    trees = iter(_map(deptree, [txt for doc in docs for txt in doc]))
+    return [[next(trees) for _ in doc] for doc in docs]
+
+
+class IntervalIndex:
+    """
+    Index over a list of [start, end] spans (e.g. entities or tokens), sorted by
+    start, to find those containing a given span with a binary search instead
+    of scanning all of them.
+    """
+
+    def __init__(self, spans, keys):
+        # positions of spans, in the order they were given, sorted by start
+        self.order = sorted(range(len(spans)), key=lambda i: spans[i][0])
+        self.starts = [spans[i][0] for i in self.order]
+        self.ends = [spans[i][1] for i in self.order]
+        # largest end among spans sorted up to each position
+        self.max_ends = list(accumulate(self.ends, max))
+        self.keys = list(keys)
+
+    # --------------------------------------------------------------
+    # build an index over a dict of entities {id: {"start", "end", ...}}
+    @classmethod
+    def of_entities(cls, entities):
+        "build an index over a dict of entities"
+
+        return cls([(e["start"], e["end"]) for e in entities.values()], entities)
+
+    # --------------------------------------------------------------
+    # get positions (in the given order) of spans containing [start, end]
+    def containing(self, start, end):
+        "get positions (in the given order) of spans containing [start, end]"
+
+        found = []
+        # only spans starting before start, and only while any of them reaches end
+        i = bisect_right(self.starts, start) - 1
+        while i >= 0 and self.max_ends[i] >= end:
+            if self.ends[i] >= end:
+                found.append(self.order[i])
+            i -= 1
+        return sorted(found)
+
+    # --------------------------------------------------------------
+    # get key of the first span containing [start, end], or None
+    def first(self, start, end):
+        "get key of the first span containing [start, end], or None"
+
+        found = self.containing(start, end)
+        return self.keys[found[0]] if found else None
+
+
 class deptree:
 
     # --------------------------------------------------------------
     # analyze a sentence with stanforCore and get a dependency tree
-    def __init__(self, txt):
-        "analyze a sentence with stanforCore and get a dependency tree"
+    def __init__(self, txt, parse=None):
+        """
+        analyze a sentence with stanforCore and get a dependency tree
+        (or build it from its already obtained parse)
+        """
 
         if txt == "":
             self.tree = None
         else:
-            txt2 = (
-                txt.replace("/", " / ")
-                .replace("-", " - ")
-                .replace(".", ". ")
-                .replace("'", " ' ")
+            txt2, positions = normalize(txt)
+            if parse is None:
+                parse = parse_sentence(txt2)
+            self.tree = dep_parser.make_tree(parse)
+            self.nodes = sorted(self.tree.nodes)[1:]
+
+            for t in self.get_nodes():
+                # enrich tree nodes with offset in original text.
+                token = parse["tokens"][t - 1]
+                self.tree.nodes[t]["start"] = positions[token["characterOffsetBegin"]]
+                self.tree.nodes[t]["end"] = positions[token["characterOffsetEnd"] - 1]
+
+            # index token spans, to find tokens overlapping a fragment
+            self.token_index = IntervalIndex(
+                [self.get_offset_span(t) for t in self.tree.nodes], self.tree.nodes
             )
-            (self.tree,) = dep_parser.raw_parse(txt2)
-            offset = 0
+
+            self.__index_tree()
 
             if DEBUG:
                 print(txt2, file=sys.stderr)
                 self.print(file=sys.stderr)
 
-            tks = []
-            for t in self.get_nodes():
-                # enrich tree nodes with offset in original text.
-                word = self.tree.nodes[t]["word"]
-                offset = txt.find(word, offset)
-                self.tree.nodes[t]["start"] = offset
-                self.tree.nodes[t]["end"] = offset + len(word) - 1
-                offset += len(word)
+    # --------------------------------------------------------------
+    # precompute children, depths, Euler tour (for LCA queries) and subtree spans
+    def __index_tree(self):
+        "precompute children, depths, Euler tour (for LCA queries) and subtree spans"
+
+        # children of each node, in the same order a scan over nodes finds them
+        self.children = {}
+        for c in list(self.tree.nodes):
+            self.children.setdefault(c, [])
+            p = self.get_parent(c)
+            if p is not None:
+                self.children.setdefault(p, []).append(c)
+
+        # depth-first walk from the root, recording the Euler tour, where it first
+        # and last visits each node, and node depths
+        self.depth = {0: 0}
+        self.first = {0: 0}
+        self.last = {}
+        self.euler = [0]
+        stack = [(0, iter(self.children[0]))]
+        while stack:
+            n, pending = stack[-1]
+            c = next(pending, None)
+            if c is None:
+                self.last[n] = len(self.euler) - 1
+                stack.pop()
+                if stack:
+                    self.euler.append(stack[-1][0])
+            elif c not in self.first:
+                self.depth[c] = self.depth[n] + 1
+                self.first[c] = len(self.euler)
+                self.euler.append(c)
+                stack.append((c, iter(self.children.get(c, []))))
+
+        # sparse table: sparse[k][i] is the shallowest node in euler[i : i + 2**k]
+        self.sparse = [self.euler]
+        k = 1
+        while 2**k <= len(self.euler):
+            prev = self.sparse[-1]
+            half = 2 ** (k - 1)
+            self.sparse.append(
+                [
+                    min(prev[i], prev[i + half], key=self.depth.__getitem__)
+                    for i in range(len(self.euler) - 2**k + 1)
+                ]
+            )
+            k += 1
+
+        # span covered by the subtree of each node, children before parents
+        self.subtree_span = {}
+        for n in sorted(self.first, key=self.first.__getitem__, reverse=True):
+            left, right = self.get_offset_span(n)
+            children = self.children.get(n, [])
+            if children:
+                left = min(left, self.subtree_span[children[0]][0])
+                right = max(right, self.subtree_span[children[-1]][1])
+            self.subtree_span[n] = (left, right)
 
     # --------------------------------------------------------------
     # return ids of nodes in the tree (tokens in the sentece)
     def get_nodes(self):
         "return ids of nodes in the tree (tokens in the sentece)"
 
-        return sorted(self.tree.nodes)[1:]
+        return self.nodes
 
     # --------------------------------------------------------------
     # return number of nodes in the tree (tokens in the sentece), (plus one for the fake root)
@@ -82,13 +527,25 @@ class deptree:
 
         if self.tree is None:
             return []
-        return [c for c in self.tree.nodes if self.get_parent(c) == n]
+        return self.children.get(n, [])
 
     # --------------------------------------------------------------
     # return the Lowest Common Subsumer of two nodes
     def get_LCS(self, n1, n2):
         "return the Lowest Common Subsumer of two nodes"
 
+        if n1 in self.first and n2 in self.first:
+            # shallowest node visited between the first visits of both nodes
+            i, j = sorted((self.first[n1], self.first[n2]))
+            k = (j - i + 1).bit_length() - 1
+            lcs = min(
+                self.sparse[k][i],
+                self.sparse[k][j - 2**k + 1],
+                key=self.depth.__getitem__,
+            )
+            # the fake root is not a subsumer (it is not among the ancestors)
+            return lcs if lcs != 0 else None
+
         # get ancestor list for each node
         a1 = self.get_ancestors(n1)
         a2 = self.get_ancestors(n2)
@@ -106,12 +563,12 @@ class deptree:
     def get_fragment_head(self, start, end):
         "get token heading the given sentence fragment (e.g. an entity span)"
 
-        # find which tokens overlap the fragment
+        # find which tokens overlap the fragment (contain its start or its end)
+        found = set(self.token_index.containing(start, start))
+        found.update(self.token_index.containing(end, end))
         overlap = set()
-        for t in self.tree.nodes:
-            tk_start, tk_end = self.get_offset_span(t)
-            if tk_start <= start <= tk_end or tk_start <= end <= tk_end:
-                overlap.add(t)
+        for i in sorted(found):
+            overlap.add(self.token_index.keys[i])
 
         head = None
         if len(overlap) > 0:
@@ -195,19 +652,19 @@ class deptree:
     def is_entity(self, n, entities):
         "check whether a token belongs to one of given entities"
 
-        for e in entities:
-            if (
-                entities[e]["start"] <= self.tree.nodes[n]["start"]
-                and self.tree.nodes[n]["end"] <= entities[e]["end"]
-            ):
-                return e
-        return None
+        # entities may be given already indexed, to look up many tokens
+        if not isinstance(entities, IntervalIndex):
+            entities = IntervalIndex.of_entities(entities)
+        return entities.first(self.tree.nodes[n]["start"], self.tree.nodes[n]["end"])
 
     # --------------------------------------------------------------
     # get span covered by a subtree rooted at node n
     def get_subtree_offset_span(self, n):
         "get span covered by a subtree rooted at node n"
 
+        if n in self.subtree_span:
+            return self.subtree_span[n]
+
         # if the node is a leaf, get its span
         left, right = self.get_offset_span(n)
         # if it is not a leaf, recurse into leftmost/rightmost children
@@ -224,6 +681,20 @@ class deptree:
     def get_up_path(self, n1, n2):
         "get upwards path from n1 to n2"
 
+        if n1 in self.first and n2 in self.first:
+            # n2 must be an ancestor of n1 (or n1 itself), other than the fake root
+            if (
+                n1 == 0
+                or n2 == 0
+                or not (self.first[n2] <= self.first[n1] <= self.last[n2])
+            ):
+                return None
+            path = []
+            for _ in range(self.depth[n1] - self.depth[n2]):
+                path.append(n1)
+                n1 = self.tree.nodes[n1]["head"]
+            return path
+
         path = self.get_ancestors(n1)
         if n2 not in path:  # error, n2 is not ancestor of n1
             return None
@@ -1,9 +1,8 @@
 #! /usr/bin/python3
 
 import sys
-from os import listdir
 
-from xml.dom.minidom import parse
+from ddixml import read_dir
 
 
 def add_instance(instance_set, einfo, etype):
@@ -21,29 +20,12 @@ def load_gold_NER(golddir):
 
     entities = {"CLASS": set([]), "NOCLASS": set([])}
 
-    # process each file in directory
-    for f in listdir(golddir):
-
-        # parse XML file, obtaining a DOM tree
-        tree = parse(golddir + "/" + f)
-
-        # process each sentence in the file
-        sentences = tree.getElementsByTagName("sentence")
-        for s in sentences:
-            sid = s.attributes["id"].value  # get sentence id
-
-            # load sentence entities
-            ents = s.getElementsByTagName("entity")
-            for e in ents:
-                einfo = (
-                    sid
-                    + "|"
-                    + e.attributes["charOffset"].value
-                    + "|"
-                    + e.attributes["text"].value
-                )
-                etype = e.attributes["type"].value
-                add_instance(entities, einfo, etype)
+    # process each sentence in the directory
+    for s in read_dir(golddir):
+        # load sentence entities
+        for e in s["entities"]:
+            einfo = s["id"] + "|" + e["charOffset"] + "|" + e["text"]
+            add_instance(entities, einfo, e["type"])
 
     return entities
 
@@ -53,28 +35,13 @@ def load_gold_DDI(golddir):
 
     relations = {"CLASS": set([]), "NOCLASS": set([])}
 
-    # process each file in directory
-    for f in listdir(golddir):
-
-        # parse XML file, obtaining a DOM tree
-        tree = parse(golddir + "/" + f)
-
-        # process each sentence in the file
-        sentences = tree.getElementsByTagName("sentence")
-        for s in sentences:
-            sid = s.attributes["id"].value  # get sentence id
-
-            # load "pairs"  in the sentence, keep those with ddi=true
-            pairs = s.getElementsByTagName("pair")
-            for p in pairs:
-                id_e1 = p.attributes["e1"].value
-                id_e2 = p.attributes["e2"].value
-                ddi = p.attributes["ddi"].value
-
-                if ddi == "true":
-                    rtype = p.attributes["type"].value
-                    rinfo = sid + "|" + id_e1 + "|" + id_e2
-                    add_instance(relations, rinfo, rtype)
+    # process each sentence in the directory
+    for s in read_dir(golddir):
+        # load "pairs" in the sentence, keep those with ddi=true
+        for p in s["pairs"]:
+            if p["ddi"] == "true":
+                rinfo = s["id"] + "|" + p["e1"] + "|" + p["e2"]
+                add_instance(relations, rinfo, p["type"])
 
     return relations
 
@@ -8,24 +8,13 @@
 # usage:  ./ner2gold.py data-directory
 
 import sys
-from os import listdir
-from xml.dom.minidom import parse
+from ddixml import read_dir
 
 # directory with files to process
 datadir = sys.argv[1]
 
-# process each file in directory
-for f in listdir(datadir):
-
-    tree = parse(datadir + "/" + f)
-
-    entities = tree.getElementsByTagName("entity")
-    for e in entities:
-        sent_id = ".".join(e.attributes["id"].value.split(".")[:-1])
-        print(
-            sent_id,
-            e.attributes["charOffset"].value,
-            e.attributes["text"].value,
-            e.attributes["type"].value,
-            sep="|",
-        )
+# process each sentence in the directory
+for s in read_dir(datadir):
+    for e in s["entities"]:
+        sent_id = ".".join(e["id"].split(".")[:-1])
+        print(sent_id, e["charOffset"], e["text"], e["type"], sep="|")